@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+# Benchmark work queue claim latency with concurrent workers.
+#
+# Args are:
+#  scratch database name (it is created, and its work_queue table replaced),
+#    which must start with bench_ or test_ and not be the configured database
+#  number of queued rows per worker (optional, default 20)
+#
+# The database server and credentials come from the normal config file. The
+# benchmark runs 1, 10 and 50 simulated workers, each claiming rows with
+# workunit.dequeue_work until the queue is empty, and reports latencies.
+
+import MySQLdb
+import multiprocessing
+import sys
+import time
+
+import utils
+import workunit
+
+
+WORKER_COUNTS = [1, 10, 50]
+# workunit only knows the work_queue table, so the benchmark replaces it in
+# its own database, which must be named like this
+SCRATCH_PREFIXES = ('bench_', 'test_')
+
+SCHEMA = """create table work_queue (
+  id varchar(60) not null,
+  number int not null,
+  workname varchar(100) not null,
+  constraints varchar(20) not null default "",
+  attempt int not null default 0,
+  priority int not null default 0,
+  selectid varchar(40) default NULL,
+  worker varchar(100) default NULL,
+  heartbeat datetime default NULL,
+  done varchar(1) default NULL,
+  primary key (id, number, workname, constraints, attempt),
+  key pending_idx (constraints, selectid, priority)
+) engine=InnoDB;"""
+
+
+def connect(dbname):
+    flags = utils.get_config()
+    db = MySQLdb.connect(user=flags['dbuser'],
+                         db=dbname,
+                         passwd=flags['dbpassword'],
+                         host=flags['dbhost'])
+    return db.cursor(MySQLdb.cursors.DictCursor)
+
+
+def setup(dbname, rows):
+    flags = utils.get_config()
+    if not dbname.startswith(SCRATCH_PREFIXES) or dbname == flags['dbname']:
+        print ('Refusing to replace work_queue in %s, use a scratch database '
+               'named %s...' %(dbname, ' or '.join(SCRATCH_PREFIXES)))
+        sys.exit(1)
+    db = MySQLdb.connect(user=flags['dbuser'],
+                         passwd=flags['dbpassword'],
+                         host=flags['dbhost'])
+    cursor = db.cursor()
+    cursor.execute('create database if not exists %s;' % dbname)
+    cursor.execute('use %s;' % dbname)
+    cursor.execute('drop table if exists work_queue;')
+    cursor.execute(SCHEMA)
+
+    priorities = [workunit.PRIORITY_BACKFILL, workunit.PRIORITY_NEW,
+                  workunit.PRIORITY_RECHECK]
+    values = []
+    for i in range(rows):
+        values.append('("bench%d", 1, "sqlalchemy_migration_bench", '
+                      '"mysql", 0, %d)' %(i, priorities[i % 3]))
+        if len(values) == 1000 or i == rows - 1:
+            cursor.execute('insert into work_queue(id, number, workname, '
+                           'constraints, attempt, priority) values %s;'
+                           % ', '.join(values))
+            values = []
+    cursor.execute('commit;')
+
+
+def claim_until_empty(args):
+    dbname, worker = args
+    cursor = connect(dbname)
+    latencies = []
+    while True:
+        start = time.time()
+        try:
+            workunit.dequeue_work(cursor, worker, 'mysql')
+        except workunit.NoWorkFound:
+            return latencies
+        latencies.append(time.time() - start)
+
+
+def percentile(values, pct):
+    index = min(len(values) - 1, int(len(values) * pct / 100.0))
+    return values[index]
+
+
+if __name__ == '__main__':
+    dbname = sys.argv[1]
+    per_worker = 20
+    if len(sys.argv) > 2:
+        per_worker = int(sys.argv[2])
+
+    print 'workers  claims  total(s)  p50(ms)  p95(ms)  max(ms)'
+    for workers in WORKER_COUNTS:
+        setup(dbname, workers * per_worker)
+        pool = multiprocessing.Pool(workers)
+        start = time.time()
+        results = pool.map(claim_until_empty,
+                           [(dbname, 'bench%d' % i) for i in range(workers)])
+        elapsed = time.time() - start
+        pool.close()
+        pool.join()
+
+        latencies = sorted(sum(results, []))
+        print ('%7d  %6d  %8.2f  %7.2f  %7.2f  %7.2f'
+               %(workers, len(latencies), elapsed,
+                 percentile(latencies, 50) * 1000,
+                 percentile(latencies, 95) * 1000,
+                 latencies[-1] * 1000))
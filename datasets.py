@@ -0,0 +1,387 @@
+#!/usr/bin/python
+
+"""Restore test datasets from cached template databases."""
+
+# Replaying /srv/datasets/<dataset>.sql through the mysql client for every
+# job is slow. Instead each dataset is loaded once into a template database
+# on this server, and jobs get a copy of the template. The template is
+# rebuilt automatically when the .sql file changes.
+#
+# Copies are made by transportable tablespace import where the server
+# supports it (MySQL 5.6+ with innodb_file_per_table and a datadir we can
+# write to), and otherwise with server side INSERT ... SELECT, which still
+# avoids parsing the dump again. Either way tables are created from the
+# template's SHOW CREATE TABLE, as CREATE TABLE ... LIKE leaves out foreign
+# keys, and views are recreated from SHOW CREATE VIEW.
+#
+# The state of a dataset after upgrading to a given trunk commit is cached
+# the same way, so jobs for the same trunk only run the patchset migrations.
+#
+# Usage: see USAGE below.
+
+
+import datetime
+import fcntl
+import json
+import MySQLdb
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+
+DATASET_DIR = '/srv/datasets'
+ROOT_DEFAULTS_FILE = '/srv/config/mysql'
+TEMPLATE_PREFIX = 'tmpl_'
+STATE_PREFIX = 'state_'
+SNAPSHOT_TABLE = '_ci_snapshot'
+
+# Cached upgraded states kept per dataset
+MAX_STATES = 3
+# Upgrade steps whose results can come from a cached state, in order
+UPGRADE_STEPS = ['grizzly', 'trunk']
+
+
+def log(msg):
+    print '%s %s' %(datetime.datetime.now(), msg)
+    sys.stdout.flush()
+
+
+def root_cursor(db=None):
+    args = {'read_default_file': ROOT_DEFAULTS_FILE,
+            'user': 'root'}
+    if db:
+        args['db'] = db
+    return MySQLdb.connect(**args).cursor()
+
+
+def template_name(dataset):
+    return TEMPLATE_PREFIX + dataset
+
+
+def source_key(dataset):
+    st = os.stat(os.path.join(DATASET_DIR, dataset + '.sql'))
+    return '%d:%d' %(st.st_size, int(st.st_mtime))
+
+
+def _database_exists(cursor, name):
+    cursor.execute('select schema_name from information_schema.schemata '
+                   'where schema_name=%s;', (name,))
+    return cursor.rowcount > 0
+
+
+def _template_key(cursor, template):
+    if not _database_exists(cursor, template):
+        return None
+    cursor.execute('select count(*) from information_schema.tables where '
+                   'table_schema=%s and table_name=%s;',
+                   (template, SNAPSHOT_TABLE))
+    if cursor.fetchone()[0] == 0:
+        return None
+    cursor.execute('select source from `%s`.`%s`;'
+                   %(template, SNAPSHOT_TABLE))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return row[0]
+
+
+def _tables(cursor, db):
+    cursor.execute('select table_name, engine from information_schema.tables '
+                   'where table_schema=%s and table_type="BASE TABLE" and '
+                   'table_name != %s;', (db, SNAPSHOT_TABLE))
+    return list(cursor.fetchall())
+
+
+def _views(cursor, db):
+    cursor.execute('select table_name from information_schema.views '
+                   'where table_schema=%s;', (db,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _create_table(cursor, src, table):
+    # cursor is connected to the database the table is created in
+    cursor.execute('show create table `%s`.`%s`;' %(src, table))
+    cursor.execute(cursor.fetchone()[1])
+
+
+def _copy_views(src, dst, views):
+    cursor = root_cursor(dst)
+    definitions = {}
+    for view in views:
+        cursor.execute('show create view `%s`.`%s`;' %(src, view))
+        # Names in the definition are qualified with the source database
+        definitions[view] = cursor.fetchone()[1].replace('`%s`.' % src, '')
+
+    # Views can be defined in terms of each other, so keep going until every
+    # view exists or a pass makes no progress
+    remaining = list(views)
+    while remaining:
+        failed = []
+        error = None
+        for view in remaining:
+            try:
+                cursor.execute(definitions[view])
+            except MySQLdb.Error, e:
+                failed.append(view)
+                error = e
+        if len(failed) == len(remaining):
+            raise error
+        remaining = failed
+
+
+def ensure_template(dataset, engine):
+    """Load the dataset into its template database if it is stale."""
+
+    cursor = root_cursor()
+    template = template_name(dataset)
+    key = source_key(dataset)
+    if _template_key(cursor, template) == key:
+        return template
+
+    log('Building %s template for dataset %s' %(engine, dataset))
+    start = time.time()
+    cursor.execute('drop database if exists `%s`;' % template)
+    cursor.execute('create database `%s`;' % template)
+    with open(os.path.join(DATASET_DIR, dataset + '.sql')) as f:
+        subprocess.check_call(['mysql', '--defaults-file=%s'
+                               % ROOT_DEFAULTS_FILE, '-u', 'root', template],
+                              stdin=f)
+
+    _write_marker(cursor, template, key, engine)
+    log('Template %s built in %.02f seconds'
+        %(template, time.time() - start))
+    return template
+
+
+def _can_import_tablespaces(cursor):
+    cursor.execute('select @@version, @@innodb_file_per_table, @@datadir;')
+    version, per_table, datadir = cursor.fetchone()
+    major_minor = tuple(int(x) for x in version.split('-')[0].split('.')[:2])
+    if major_minor < (5, 6) or not per_table:
+        return None
+    if not os.access(datadir, os.W_OK):
+        return None
+    return datadir
+
+
+def _copy_by_tablespace(datadir, template, db, tables):
+    # The export lock only lasts as long as the session holding it
+    lock_cursor = root_cursor(template)
+    cursor = root_cursor(db)
+    cursor.execute('set foreign_key_checks=0;')
+
+    for table, _ in tables:
+        _create_table(cursor, template, table)
+        cursor.execute('alter table `%s` discard tablespace;' % table)
+
+    lock_cursor.execute('flush tables %s for export;'
+                        % ', '.join(['`%s`' % t for t, _ in tables]))
+    copied = []
+    try:
+        try:
+            for table, _ in tables:
+                for ext in ['.ibd', '.cfg']:
+                    src = os.path.join(datadir, template, table + ext)
+                    dst = os.path.join(datadir, db, table + ext)
+                    if os.path.exists(src):
+                        shutil.copyfile(src, dst)
+                        copied.append(dst)
+                        # The server must be able to open the copy, which
+                        # it can't if it belongs to whoever runs the job
+                        st = os.stat(src)
+                        os.chown(dst, st.st_uid, st.st_gid)
+                        os.chmod(dst, stat.S_IMODE(st.st_mode))
+        finally:
+            lock_cursor.execute('unlock tables;')
+
+        for table, _ in tables:
+            cursor.execute('alter table `%s` import tablespace;' % table)
+    except:
+        # Leave nothing the server doesn't know about behind for the caller
+        # to drop the database over
+        for path in copied:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+    cursor.execute('set foreign_key_checks=1;')
+
+
+def _copy_by_select(template, db, tables):
+    cursor = root_cursor(db)
+    cursor.execute('set foreign_key_checks=0;')
+    for table, _ in tables:
+        _create_table(cursor, template, table)
+        cursor.execute('insert into `%s` select * from `%s`.`%s`;'
+                       %(table, template, table))
+    cursor.execute('set foreign_key_checks=1;')
+    cursor.execute('commit;')
+
+
+def restore(dataset, db, engine):
+    """Replace database db with a fresh copy of dataset."""
+
+    # Concurrent worker slots may use, or rebuild, the same template
+    with open(os.path.join(DATASET_DIR, dataset + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        _restore_locked(dataset, db, engine)
+
+
+def _restore_locked(dataset, db, engine):
+    start = time.time()
+    template = ensure_template(dataset, engine)
+    template_ready = time.time()
+    method = clone(template, db)
+
+    # The job log is parsed for this line, see workunit.RESTORE_TIME_RE
+    log('Dataset %s restored to %s by %s in %.02f seconds '
+        '(template %.02f seconds)'
+        %(dataset, db, method, time.time() - start, template_ready - start))
+
+
+def clone(src, dst):
+    """Replace database dst with a copy of src. Returns the method used."""
+
+    cursor = root_cursor()
+    cursor.execute('drop database if exists `%s`;' % dst)
+    cursor.execute('create database `%s`;' % dst)
+
+    tables = _tables(cursor, src)
+    datadir = _can_import_tablespaces(cursor)
+    innodb = [t for t in tables if t[1] == 'InnoDB']
+    other = [t for t in tables if t[1] != 'InnoDB']
+
+    method = 'copy'
+    if datadir and innodb:
+        try:
+            _copy_by_tablespace(datadir, src, dst, innodb)
+            method = 'tablespace'
+        except (MySQLdb.Error, OSError, IOError), e:
+            log('Tablespace import of %s failed, copying instead: %s'
+                %(src, e))
+            cursor.execute('drop database if exists `%s`;' % dst)
+            cursor.execute('create database `%s`;' % dst)
+            other = tables
+    else:
+        other = tables
+    if other:
+        _copy_by_select(src, dst, other)
+
+    views = _views(cursor, src)
+    if views:
+        _copy_views(src, dst, views)
+    return method
+
+
+def _write_marker(cursor, db, key, engine, timings=None):
+    # Written last, so a half built template is never trusted
+    cursor.execute('create table `%s`.`%s` (source varchar(255), '
+                   'engine varchar(32), built datetime, timings text);'
+                   %(db, SNAPSHOT_TABLE))
+    cursor.execute('insert into `%s`.`%s` values (%%s, %%s, NOW(), %%s);'
+                   %(db, SNAPSHOT_TABLE),
+                   (key, engine, json.dumps(timings or {})))
+    cursor.execute('commit;')
+
+
+def state_name(dataset, commit):
+    return '%s%s_%s' %(STATE_PREFIX, dataset, commit[:12])
+
+
+def save_state(dataset, db, engine, commit, timings):
+    """Cache db as the state of dataset after upgrading to commit.
+
+    timings maps each upgrade step (grizzly, trunk) to how long it took, so
+    jobs restoring from the cache can still report them.
+    """
+
+    with open(os.path.join(DATASET_DIR, dataset + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        start = time.time()
+        state = state_name(dataset, commit)
+        cursor = root_cursor()
+        if _template_key(cursor, state) == source_key(dataset):
+            return
+
+        method = clone(db, state)
+        _write_marker(cursor, state, source_key(dataset), engine, timings)
+        log('Cached upgraded state of %s as %s by %s in %.02f seconds'
+            %(dataset, state, method, time.time() - start))
+
+        # Trunk only moves forward, so old states are rarely useful
+        cursor.execute('select schema_name from information_schema.schemata '
+                       'where schema_name like %s;',
+                       (STATE_PREFIX + dataset.replace('_', '\\_') + '\\_%',))
+        states = []
+        for (name,) in cursor.fetchall():
+            cursor.execute('select built from `%s`.`%s`;'
+                           %(name, SNAPSHOT_TABLE))
+            row = cursor.fetchone()
+            states.append((row[0] if row else None, name))
+        states.sort(reverse=True)
+        for _, name in states[MAX_STATES:]:
+            cursor.execute('drop database `%s`;' % name)
+            log('Dropped old cached state %s' % name)
+
+
+def restore_state(dataset, db, engine, commit):
+    """Restore a cached upgraded state into db. Returns True on a hit."""
+
+    with open(os.path.join(DATASET_DIR, dataset + '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        start = time.time()
+        state = state_name(dataset, commit)
+        cursor = root_cursor()
+        if _template_key(cursor, state) != source_key(dataset):
+            log('No cached upgraded state for %s at %s' %(dataset, commit))
+            return False
+
+        cursor.execute('select timings from `%s`.`%s`;'
+                       %(state, SNAPSHOT_TABLE))
+        timings = json.loads(cursor.fetchone()[0])
+        method = clone(state, db)
+
+    log('Dataset %s restored to %s from cached state %s by %s in %.02f '
+        'seconds' %(dataset, db, state, method, time.time() - start))
+
+    # The job log is parsed for these lines, see workunit.CACHED_UPGRADE_RE
+    for step in UPGRADE_STEPS:
+        if step in timings:
+            log('***** DB upgrade to state of %s cached, originally took '
+                '%.02f seconds *****' %(step, timings[step]))
+    return True
+
+
+USAGE = """Usage:
+    %(prog)s restore <dataset> <database> <engine>
+    %(prog)s save-state <dataset> <database> <engine> <commit> [step=seconds]
+    %(prog)s restore-state <dataset> <database> <engine> <commit>
+
+restore-state exits with 0 if the cached state was restored, 1 otherwise."""
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 5:
+        print USAGE % {'prog': sys.argv[0]}
+        sys.exit(2)
+
+    command = sys.argv[1]
+    dataset, db, engine = sys.argv[2:5]
+    if command == 'restore' and len(sys.argv) == 5:
+        restore(dataset, db, engine)
+    elif command == 'save-state' and len(sys.argv) >= 6:
+        timings = {}
+        for arg in sys.argv[6:]:
+            step, seconds = arg.split('=')
+            timings[step] = float(seconds)
+        save_state(dataset, db, engine, sys.argv[5], timings)
+    elif command == 'restore-state' and len(sys.argv) == 6:
+        if not restore_state(dataset, db, engine, sys.argv[5]):
+            sys.exit(1)
+    else:
+        print USAGE % {'prog': sys.argv[0]}
+        sys.exit(2)
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+"""A small, bounded pool of MySQL connections shared by all entry points."""
+
+# utils.get_cursor() hands out cursors backed by this pool. A connection goes
+# back to the pool when the cursor is closed or garbage collected, so the
+# existing "cursor = utils.get_cursor()" call sites need no changes.
+
+
+import datetime
+import MySQLdb
+import Queue
+import threading
+import time
+
+
+# MySQL client errors which mean the connection is dead and should be
+# replaced rather than reported to the caller.
+GONE_AWAY_ERRORS = (2006,  # MySQL server has gone away
+                    2013)  # Lost connection to MySQL server during query
+
+DEFAULT_SIZE = 10
+DEFAULT_TIMEOUT = 60
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class Pool(object):
+    def __init__(self, connect_args, size=DEFAULT_SIZE,
+                 timeout=DEFAULT_TIMEOUT):
+        self.connect_args = connect_args
+        self.size = size
+        self.timeout = timeout
+
+        self.idle = Queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+
+        self.counters = {'checkouts': 0,
+                         'waits': 0,
+                         'wait_seconds': 0.0,
+                         'connects': 0,
+                         'reconnects': 0,
+                         'discarded': 0}
+
+    def _count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = self.size
+            stats['open'] = self.created
+            stats['idle'] = self.idle.qsize()
+        return stats
+
+    def _connect(self):
+        self._count('connects')
+        return MySQLdb.connect(**self.connect_args)
+
+    def _healthy(self, db):
+        try:
+            db.ping()
+            return True
+        except MySQLdb.OperationalError:
+            return False
+
+    def checkout(self):
+        """Return a live connection, waiting if the pool is fully used."""
+
+        self._count('checkouts')
+        try:
+            db = self.idle.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                if self.created < self.size:
+                    self.created += 1
+                    create = True
+                else:
+                    create = False
+
+            if create:
+                try:
+                    return self._connect()
+                except:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+
+            self._count('waits')
+            start = time.time()
+            try:
+                db = self.idle.get(timeout=self.timeout)
+            except Queue.Empty:
+                raise PoolExhausted('No database connection free after %d '
+                                    'seconds (pool size %d)'
+                                    %(self.timeout, self.size))
+            finally:
+                self._count('wait_seconds', time.time() - start)
+
+        if not self._healthy(db):
+            db = self.replace(db)
+        return db
+
+    def checkin(self, db):
+        try:
+            # Don't hand out a connection with an open transaction
+            db.rollback()
+        except MySQLdb.Error:
+            self.discard(db)
+            return
+        self.idle.put(db)
+
+    def discard(self, db):
+        self._count('discarded')
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+        with self.lock:
+            self.created -= 1
+
+    def replace(self, db):
+        """Swap a dead connection for a fresh one in the same pool slot."""
+
+        self._count('reconnects')
+        print '%s Reconnecting to database' % datetime.datetime.now()
+        try:
+            db.close()
+        except MySQLdb.Error:
+            pass
+        try:
+            return self._connect()
+        except:
+            with self.lock:
+                self.created -= 1
+            raise
+
+
+class PooledCursor(object):
+    """A DictCursor which returns its connection to the pool when done.
+
+    If the server has gone away the statement is retried once on a new
+    connection, but only if nothing other than plain selects has run since
+    the last commit or rollback. Otherwise the earlier statements of the
+    transaction were lost with the connection, and the error is raised so
+    the caller knows.
+    """
+
+    _db = None
+    _cursor = None
+    _in_transaction = False
+
+    def __init__(self, pool, cursorclass=MySQLdb.cursors.DictCursor):
+        self._pool = pool
+        self._cursorclass = cursorclass
+        self._db = pool.checkout()
+        self._cursor = self._db.cursor(cursorclass)
+
+    def execute(self, sql, args=None):
+        try:
+            result = self._cursor.execute(sql, args)
+        except MySQLdb.OperationalError, e:
+            if e.args[0] not in GONE_AWAY_ERRORS:
+                raise
+            in_transaction = self._in_transaction
+            self._db = self._pool.replace(self._db)
+            self._cursor = self._db.cursor(self._cursorclass)
+            self._in_transaction = False
+            if in_transaction:
+                raise
+            result = self._cursor.execute(sql, args)
+
+        # Plain reads can be replayed, anything else since the last commit
+        # can't
+        statement = sql.strip().rstrip(';').lower()
+        if statement in ('commit', 'rollback'):
+            self._in_transaction = False
+        elif (not statement.startswith('select') or
+              statement.endswith('for update') or
+              statement.endswith('skip locked')):
+            self._in_transaction = True
+        return result
+
+    def close(self):
+        if self._db is None:
+            return
+        try:
+            self._cursor.close()
+        except MySQLdb.Error:
+            pass
+        self._pool.checkin(self._db)
+        self._db = None
+        self._cursor = None
+
+    def __del__(self):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(flags):
+    """Return the process wide pool, rebuilding it if the config changed."""
+
+    global _pool
+    global _pool_key
+
+    connect_args = {'user': flags['dbuser'],
+                    'db': flags['dbname'],
+                    'passwd': flags['dbpassword'],
+                    'host': flags['dbhost']}
+    key = (tuple(sorted(connect_args.items())),
+           flags.get('dbpool_size', DEFAULT_SIZE),
+           flags.get('dbpool_timeout', DEFAULT_TIMEOUT))
+
+    with _pool_lock:
+        if _pool is None or _pool_key != key:
+            _pool = Pool(connect_args, size=key[1], timeout=key[2])
+            _pool_key = key
+        return _pool
+
+
+def forget_pool():
+    """Drop the process wide pool without closing its connections.
+
+    For use in a child process after a fork. The inherited connections share
+    their sockets with the parent, so closing them here would close them
+    there too. The child builds its own pool on the next get_pool().
+    """
+
+    global _pool
+    global _pool_key
+
+    with _pool_lock:
+        _pool = None
+        _pool_key = None
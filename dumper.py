@@ -5,13 +5,37 @@
 import cgi
 import datetime
 import json
+import multiprocessing
 import os
 import re
-
+import socket
+import time
+import traceback
+import uuid
+
+import dbpool
+import results
+import staticfiles
 import utils
 import workunit
 
 
+# Patchsets rendered per round of summary queries
+PAGE_BATCH = 100
+MIGRATION_FILE_RE = re.compile('([0-9]+)_.*\.py$')
+
+ARCHIVE_DIR = '/var/www/ci/archive'
+ARCHIVE_MANIFEST = os.path.join(ARCHIVE_DIR, 'manifest.json')
+# How long after a month ends before its page is final
+ARCHIVE_CLOSE_AFTER = datetime.timedelta(days=1)
+
+# Pending jobs claimed for rendering at a time
+RENDER_BATCH = 50
+# A claim older than this belongs to a dumper which died, and is retaken
+RENDER_CLAIM_SECONDS = 1800
+RENDER_PROGRESS_INTERVAL = 30
+
+
 NEW_RESULT_EMAIL = """Results for a test are available.
 
     %(results)s
@@ -24,47 +48,110 @@ def test_name_as_display(test):
                 replace('_', ' ')
 
 
-def write_index(sql, filename):
-    # Write out an index file
+def render_patchset(key, patchset, test_names, latest, base=''):
+    """The table cells for a patchset's row of the index.
+
+    base is the path from the page to the top of the site.
+    """
+
+    out = ('<td>'
+           '<a href="%(base)s%(id)s/%(num)s">%(id)s #%(num)s</a><br/>'
+           '<font size="-1">%(proj)s at %(timestamp)s<br/>'
+           '<a href="%(url)s">%(subj)s by %(who)s</a><br/>'
+           '</font></td>'
+           % {'base': base,
+              'id': key[0],
+              'num': key[1],
+              'proj': patchset['project'],
+              'timestamp': patchset['timestamp'],
+              'subj': patchset['subject'],
+              'who': patchset['owner_name'],
+              'url': patchset['url']})
+    for test in test_names:
+        out += '<td><table>'
+        for row in latest.get((key[0], key[1], test), []):
+            data = row['data']
+            if not data:
+                out += ('<tr><td>&nbsp;</td></tr>')
+                continue
+
+            work = workunit.WorkUnit(row['id'], row['number'],
+                                     row['workname'], row['attempt'],
+                                     row['constraints'])
+            color = data.get('color', '')
+            out += ('<tr %s><td><b>%s</b> ['
+                    '<a href="%s/log.html">log</a>]'
+                    '<font size="-1">'
+                    %(color, work.constraints, work.url()))
+
+            if data.get('result', ''):
+                out += ('<br/>&nbsp;&nbsp;<b>%s</b><br/>'
+                        % data.get('result', ''))
+
+            for upgrade in data['order']:
+                out += ('<br/>&nbsp;&nbsp;%s: %s'
+                        %(upgrade, data['details'][upgrade]))
+
+            if data.get('final_schema_version', ''):
+                out += ('<br/>&nbsp;&nbsp;'
+                        'Final schema version: %s'
+                        % data.get('final_schema_version'))
+            if data.get('expected_final_schema_version', ''):
+                out += ('<br/>&nbsp;&nbsp;'
+                        'Expected schema version: %s'
+                        % data.get('expected_final_schema_version'))
+
+            out += ('<br/>&nbsp;&nbsp;Run at %s' % row['heartbeat'])
+
+            if work.attempt > 0:
+                out += ('<br/><br/>&nbsp;&nbsp;Other attempts: ')
+                for i in range(0, work.attempt):
+                    out += ('<a href="%s/log.html">%s</a> '
+                            %(work.url(attempt=i), i))
+
+            out += ('</font></td></tr>')
+        out += ('</table></td>')
+    return out
+
+
+def summary_header():
+    counts = results.summary(cursor)
+    return ('<p>This page lists recent CI tests run by this system.</p>\n'
+            '<p>There are currently %(total)s patchsets tracked and '
+            '%(retries)s rechecks, with %(jobs_done)s jobs having been '
+            'run. There are %(jobs_queued)s jobs queued to run. The most '
+            'recent patchset is from %(recent)s. Older tests are in the '
+            '<a href="all.html">archive</a>.</p>'
+            %{'total': counts['total'],
+              'retries': counts['rechecks'],
+              'jobs_done': counts['jobs_done'],
+              'jobs_queued': counts['jobs_queued'],
+              'recent': counts['recent']})
+
+
+def write_index(sql, filename, title='Recent tests', header=None, base=''):
+    # Write out an index file. Everything on the page is fetched with a few
+    # queries covering a batch of the patchsets listed at a time, see
+    # results.
     order = []
+    seen = set()
     test_names = []
     cursor.execute(sql)
     for row in cursor:
         key = (row['id'], row['number'])
 
-        if not key in order:
+        if not key in seen:
+            seen.add(key)
             order.append(key)
         if not row['workname'] in test_names:
             test_names.append(row['workname'])
 
-    with open(filename, 'w') as f:
-        cursor.execute('select count(*) from patchsets;')
-        total = cursor.fetchone()['count(*)']
-        cursor.execute('select count(*) from patchset_rechecks;')
-        rechecks = cursor.fetchone()['count(*)']
-
-        cursor.execute('select timestamp from patchsets order by '
-                       'timestamp desc limit 1;')
-        recent = cursor.fetchone()['timestamp']
-        cursor.execute('select count(*) from work_queue where done="y";')
-        jobs_done = cursor.fetchone()['count(*)']
-        cursor.execute('select count(*) from work_queue where done is null;')
-        jobs_queued = cursor.fetchone()['count(*)']
-
-        f.write('<html><head><title>Recent tests</title></head><body>\n'
-                '<p>This page lists recent CI tests run by this system.</p>\n'
-                '<p>There are currently %(total)s patchsets tracked and '
-                '%(retries)s rechecks, with %(jobs_done)s jobs having been '
-                'run. There are %(jobs_queued)s jobs queued to run. The most '
-                'recent patchset is from %(recent)s. This page was last '
-                'updated at %(now)s.</p>'
-                '<table><tr><td><b>Patchset</b></td>'
-                %{'total': total,
-                  'retries': rechecks,
-                  'jobs_done': jobs_done,
-                  'jobs_queued': jobs_queued,
-                  'recent': recent,
-                  'now': datetime.datetime.now()})
+    if header is None:
+        header = summary_header()
+
+    with staticfiles.StaticFile(filename) as f:
+        f.write('<html><head><title>%s</title></head><body>\n%s'
+                '<table><tr><td><b>Patchset</b></td>' %(title, header))
 
         test_names.sort()
         for test in test_names:
@@ -73,104 +160,329 @@ def write_index(sql, filename):
 
         row_colors = ['', ' bgcolor="#CCCCCC"']
         row_count = 0
-        for key in order:
-            cursor.execute('select * from patchsets where id="%s" and '
-                           'number=%s order by timestamp desc limit 1;'
-                           %(key[0], key[1]))
-            row = cursor.fetchone()
-            out = ('<td>'
-                   '<a href="%(id)s/%(num)s">%(id)s #%(num)s</a><br/>'
-                   '<font size="-1">%(proj)s at %(timestamp)s<br/>'
-                   '<a href="%(url)s">%(subj)s by %(who)s</a><br/>'
-                   '</font></td>'
-                   % {'id': key[0],
-                      'num': key[1],
-                      'proj': row['project'],
-                      'timestamp': row['timestamp'],
-                      'subj': row['subject'],
-                      'who': row['owner_name'],
-                      'url': row['url']})
-            for test in test_names:
-                out += '<td><table>'
-                for work in workunit.find_latest_attempts(cursor, key[0],
-                                                          key[1], test):
-                    test_dir = work.disk_path()
-                    if os.path.exists(test_dir):
-                        with open(os.path.join(test_dir, 'data'), 'r') as d:
-                            data = json.loads(d.read())
-                        color = data.get('color', '')
-                        out += ('<tr %s><td><b>%s</b> ['
-                                '<a href="%s/log.html">log</a>]'
-                                '<font size="-1">'
-                                %(color, work.constraints, work.url()))
-
-                        if data.get('result', ''):
-                            out += ('<br/>&nbsp;&nbsp;<b>%s</b><br/>'
-                                    % data.get('result', ''))
-
-                        for upgrade in data['order']:
-                            out += ('<br/>&nbsp;&nbsp;%s: %s'
-                                    %(upgrade, data['details'][upgrade]))
-
-                        if data.get('final_schema_version', ''):
-                            out += ('<br/>&nbsp;&nbsp;'
-                                    'Final schema version: %s'
-                                    % data.get('final_schema_version'))
-                        if data.get('expected_final_schema_version', ''):
-                            out += ('<br/>&nbsp;&nbsp;'
-                                    'Expected schema version: %s'
-                                    % data.get('expected_final_schema_version'))
-
-                        cursor.execute('select * from work_queue where id="%s" '
-                                       'and number=%s and workname="%s";'
-                                       %(key[0], key[1], test))
-                        row = cursor.fetchone()
-                        out += ('<br/>&nbsp;&nbsp;Run at %s'
-                                % row['heartbeat'])
-
-                        if work.attempt > 0:
-                            out += ('<br/><br/>&nbsp;&nbsp;Other attempts: ')
-                            for i in range(0, work.attempt):
-                                out += ('<a href="%s/log.html">%s</a> '
-                                        %(work.url(attempt=i), i))
-
-                        out += ('</font></td></tr>')
-                    else:
-                        out += ('<tr><td>&nbsp;</td></tr>')
-                out += ('</table></td>')
-
-            with open(os.path.join('/var/www/ci', key[0], str(key[1]),
-                                   'index.html'), 'w') as idx:
+        for i in range(0, len(order), PAGE_BATCH):
+            batch = order[i:i + PAGE_BATCH]
+            patchsets = results.patchsets(cursor, batch)
+            latest = results.latest_results(cursor, batch)
+            for key in batch:
+                out = render_patchset(key, patchsets[key], test_names,
+                                      latest, base=base)
+                f.write('<tr%(color)s>%(out)s</tr>\n'
+                        %{'color': row_colors[row_count % 2],
+                          'out': out})
+                row_count += 1
+        f.write('</table></body></html>')
+
+
+# The archive has a page per month of jobs, by when they ran, listed in
+# all.html and archive/manifest.json. Once a month is over and all its jobs
+# are dumped it is closed, and its page is never written again.
+
+def read_manifest():
+    if not os.path.exists(ARCHIVE_MANIFEST):
+        return {'months': []}
+    with open(ARCHIVE_MANIFEST) as f:
+        return json.loads(f.read())
+
+
+def _next_month(month):
+    if month.month == 12:
+        return datetime.datetime(month.year + 1, 1, 1)
+    return datetime.datetime(month.year, month.month + 1, 1)
+
+
+def write_archive(now, dirty):
+    """Write the pages of open months with dirty patchsets, then the manifest.
+
+    dirty is a list of (id, number) keys.
+    """
+
+    manifest = read_manifest()
+    months = {}
+    for entry in manifest['months']:
+        months[entry['month']] = entry
+
+    # Only months from the oldest open one on need looking at. A month can
+    # stay open after later ones close, for example while one of its jobs
+    # fails to render.
+    open_months = [m for m in months if not months[m]['closed']]
+    since = datetime.datetime(1970, 1, 1)
+    if open_months:
+        since = datetime.datetime.strptime(min(open_months), '%Y-%m')
+    elif months:
+        since = _next_month(datetime.datetime.strptime(max(months),
+                                                       '%Y-%m'))
+    changed_months = results.job_months(cursor, dirty)
+
+    cursor.execute('select date_format(heartbeat, "%%Y-%%m") as month, '
+                   'count(*) as jobs, count(distinct id, number) '
+                   'as patchsets, sum(done is null or dumped is null) '
+                   'as pending from work_queue where heartbeat >= %s '
+                   'group by month;', (since,))
+    rows = cursor.fetchall()
+
+    if not os.path.exists(ARCHIVE_DIR):
+        os.makedirs(ARCHIVE_DIR)
+    for row in rows:
+        if row['month'] is None:
+            continue
+        if row['month'] in months and months[row['month']]['closed']:
+            continue
+
+        start = datetime.datetime.strptime(row['month'], '%Y-%m')
+        end = _next_month(start)
+        page = os.path.join(ARCHIVE_DIR, row['month'] + '.html')
+        if row['month'] in changed_months or not os.path.exists(page):
+            write_index('select * from work_queue where heartbeat >= "%s" '
+                        'and heartbeat < "%s" order by heartbeat desc;'
+                        %(start, end),
+                        page,
+                        title='Tests run in %s' % row['month'],
+                        header=('<p>CI tests run in %s. See also the '
+                                '<a href="../index.html">most recent '
+                                'tests</a> and <a href="../all.html">other '
+                                'months</a>.</p>' % row['month']),
+                        base='../')
+        months[row['month']] = {
+            'month': row['month'],
+            'url': 'archive/%s.html' % row['month'],
+            'jobs': int(row['jobs']),
+            'patchsets': int(row['patchsets']),
+            'closed': end + ARCHIVE_CLOSE_AFTER < now and not row['pending']}
+
+    # No timestamp of its own, so the manifest is only rewritten when a
+    # month changes
+    manifest = {'months': [months[month]
+                           for month in sorted(months, reverse=True)]}
+    with staticfiles.StaticFile(ARCHIVE_MANIFEST) as f:
+        f.write(json.dumps(manifest, indent=1, sort_keys=True))
+
+    with staticfiles.StaticFile('/var/www/ci/all.html') as f:
+        f.write('<html><head><title>All tests</title></head><body>\n'
+                '<p>CI tests run by this system, by month. The '
+                '<a href="index.html">most recent tests</a> have their own '
+                'page.</p><ul>\n')
+        for entry in manifest['months']:
+            f.write('<li><a href="%(url)s">%(month)s</a>: %(jobs)d jobs for '
+                    '%(patchsets)d patchsets\n' % entry)
+        f.write('</ul></body></html>')
+
+
+def write_patchset_pages(keys):
+    """Write the index.html of each patchset in keys."""
+
+    for i in range(0, len(keys), PAGE_BATCH):
+        batch = keys[i:i + PAGE_BATCH]
+        patchsets = results.patchsets(cursor, batch)
+        latest = results.latest_results(cursor, batch)
+
+        tests = {}
+        for ident, number, workname in latest:
+            tests.setdefault((ident, number), []).append(workname)
+
+        for key in batch:
+            if not key in patchsets:
+                continue
+            out = render_patchset(key, patchsets[key],
+                                  sorted(tests.get(key, [])), latest)
+            path = os.path.join('/var/www/ci', key[0], str(key[1]))
+            if not os.path.exists(path):
+                os.makedirs(path)
+            with staticfiles.StaticFile(os.path.join(path,
+                                                     'index.html')) as idx:
                 idx.write('<table><tr>%s</tr></table>' % out)
 
-            f.write('<tr%(color)s>%(out)s</tr>\n'
-                    %{'color': row_colors[row_count % 2],
-                      'out': out})
-            row_count += 1
-        f.write('</table></body></html>')
+
+def write_migration_page(migration):
+    with staticfiles.StaticFile(os.path.join('/var/www/ci/migrations/nova',
+                                             str(migration) + '.html')) as f:
+        sql = ('select distinct(id) from patchset_files '
+               'where filename like '
+               '"nova/db/sqlalchemy/migrate_repo/versions/%s_%%" '
+               'order by id;'
+               % migration)
+        cursor.execute(sql)
+        counter = 1
+        for row in cursor:
+            f.write('<li><a href="http://review.openstack.org/#/q/%s,n,z">'
+                    '%s</a>' %(row['id'], row['id']))
+            counter += 1
+        f.write('<br/><br/>%d patchsets' %(counter - 1))
+
+
+# Rendering of finished jobs' logs. Pending jobs are claimed a batch at a
+# time by setting work_queue.dump_claim (schema/006) in a single update, so
+# dumpers running at once render disjoint jobs. Each batch is spread over a
+# pool of processes, each with its own database connections.
+
+def claim_pending(count):
+    """Claim up to count jobs which need rendering, returning their rows."""
+
+    claim = '%s-%d-%s' %(socket.gethostname(), os.getpid(), uuid.uuid4())
+    cursor.execute('update work_queue set dump_claim="%s", '
+                   'dump_claimed=NOW() where done is not null and '
+                   'dumped is null and (dump_claim is null or '
+                   'dump_claimed < NOW() - INTERVAL %d SECOND) '
+                   'order by heartbeat limit %d;'
+                   %(claim, RENDER_CLAIM_SECONDS, count))
+    # Read before the commit, which has a row count of its own
+    claimed = cursor.rowcount
+    cursor.execute('commit;')
+    if claimed == 0:
+        return []
+    cursor.execute('select * from work_queue where dump_claim="%s" and '
+                   'dumped is null;' % claim)
+    return cursor.fetchall()
+
+
+def _init_render_process():
+    dbpool.forget_pool()
+
+
+def render_job(row):
+    """Render one job's log. Runs in a render process."""
+
+    start = time.time()
+    work = workunit.WorkUnit(row['id'], row['number'], row['workname'],
+                             row['attempt'], row['constraints'])
+    work.worker = row['worker']
+    try:
+        jobcursor = utils.get_cursor()
+        work.persist_to_disk(jobcursor)
+        work.mark_dumped(jobcursor)
+    except Exception:
+        return row, time.time() - start, traceback.format_exc()
+    return row, time.time() - start, None
+
+
+def render_pending(processes):
+    """Render every job which needs it, processes at a time."""
+
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_render_process)
+
+    start = time.time()
+    last_report = start
+    rendered = 0
+    failed = 0
+    busy = 0.0
+    try:
+        while True:
+            rows = claim_pending(RENDER_BATCH)
+            if not rows:
+                break
+
+            if pool:
+                done = pool.imap_unordered(render_job, rows)
+            else:
+                done = (render_job(row) for row in rows)
+
+            for row, seconds, error in done:
+                busy += seconds
+                if error:
+                    # The claim is left to expire, so the job is retried
+                    failed += 1
+                    print ('%s Failed to render %s %s %s %s(%s):\n%s'
+                           %(datetime.datetime.now(), row['id'],
+                             row['number'], row['workname'],
+                             row['constraints'], row['attempt'], error))
+                else:
+                    rendered += 1
+
+                if time.time() - last_report > RENDER_PROGRESS_INTERVAL:
+                    render_report(rendered, failed, busy, start)
+                    last_report = time.time()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if rendered or failed:
+        render_report(rendered, failed, busy, start)
+
+
+def render_report(rendered, failed, busy, start):
+    elapsed = max(time.time() - start, 0.001)
+    print ('%s Rendered %d jobs (%d failed) in %.02f seconds, %.01f jobs per '
+           'minute, %.02f seconds per job'
+           %(datetime.datetime.now(), rendered, failed, elapsed,
+             rendered * 60 / elapsed, busy / max(rendered + failed, 1)))
+
+
+# Dirty tracking. work_queue.changed is set when a job is queued, finishes or
+# is dumped, patchset_files.added when a file is recorded (schema/005), and
+# the time of the last dump is kept in dumper_state. Anything which changed
+# at or after that time is regenerated.
+
+def read_watermark():
+    cursor.execute('select value from dumper_state where name="watermark";')
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return row['value']
+
+
+def save_watermark(value):
+    cursor.execute('insert into dumper_state(name, value) '
+                   'values ("watermark", %s) '
+                   'on duplicate key update value=values(value);', (value,))
+    cursor.execute('commit;')
+
+
+def changed_patchsets(since):
+    if since is None:
+        cursor.execute('select distinct id, number from work_queue;')
+    else:
+        cursor.execute('select distinct id, number from work_queue '
+                       'where changed >= %s;', (since,))
+    return [(row['id'], row['number']) for row in cursor]
+
+
+def changed_migrations(since):
+    if since is None:
+        # Without a previous dump, only do the most recent migrations
+        cursor.execute('select max(migration) from patchset_migrations;')
+        max_migration = cursor.fetchone()['max(migration)'] or 0
+        return range(max_migration - 10, max_migration + 1)
+
+    cursor.execute('select distinct filename from patchset_files '
+                   'where added >= %s and filename like '
+                   '"nova/db/sqlalchemy/migrate_repo/versions/%%";', (since,))
+    migrations = set()
+    for row in cursor:
+        m = MIGRATION_FILE_RE.match(os.path.basename(row['filename']))
+        if m:
+            migrations.add(int(m.group(1)))
+    return sorted(migrations)
 
 
 if __name__ == '__main__':
     print '...'
+    start = time.time()
 
     cursor = utils.get_cursor()
     subcursor = utils.get_cursor()
 
+    # Taken before looking for changes, so nothing made while this dump runs
+    # is missed by the next one
+    cursor.execute('select NOW() as now;')
+    dump_started = cursor.fetchone()['now']
+    since = read_watermark()
+
     # Write out individual work logs
-    cursor.execute('select * from work_queue where done is not null '
-                   'and dumped is null;')
-    for row in cursor:
-        work = workunit.WorkUnit(row['id'], row['number'], row['workname'],
-                                 row['attempt'], row['constraints'])
-        work.worker = row['worker']
-        work.persist_to_disk(subcursor)
-        work.mark_dumped(subcursor)
-
-    # Write out an index file
-    write_index('select * from work_queue order by heartbeat desc limit 100;',
-                '/var/www/ci/index.html')
-    write_index('select * from work_queue order by heartbeat desc;',
-                '/var/www/ci/all.html')
+    render_pending(utils.get_config().get('dumper_processes',
+                                          multiprocessing.cpu_count()))
+
+    dirty = changed_patchsets(since)
+    if dirty:
+        write_patchset_pages(dirty)
+
+        # Write out an index file
+        write_index('select * from work_queue order by heartbeat desc '
+                    'limit 100;',
+                    '/var/www/ci/index.html')
+        write_archive(dump_started, dirty)
 
     # Email out results, but only if all tests complete
     candidates = {}
@@ -190,46 +502,42 @@ if __name__ == '__main__':
 
         # If we get here, then we owe people an email about a complete run of
         # tests
-        results = {}
-        cursor.execute('select * from work_queue where id="%s" and number=%s '
-                       'and done is not null;'
-                       %(ident, number))
-        for row in cursor:
+        summaries = {}
+        for row in results.results_for(cursor, ident, number):
             work = workunit.WorkUnit(row['id'], row['number'], row['workname'],
                                      row['attempt'], row['constraints'])
 
-            results.setdefault((row['workname'], row['constraints']), {})
-            results[(row['workname'],
-                     row['constraints'])].setdefault(row['attempt'], [])
-            results[(row['workname'],
-                     row['constraints'])][row['attempt']].append(
+            summaries.setdefault((row['workname'], row['constraints']), {})
+            summaries[(row['workname'],
+                       row['constraints'])].setdefault(row['attempt'], [])
+            summaries[(row['workname'],
+                       row['constraints'])][row['attempt']].append(
                           '%s attempt %s:'
                           %(test_name_as_display(row['workname']),
                             row['attempt']))
-            with open(os.path.join(work.disk_path(), 'data')) as f:
-                data = json.loads(f.read())
-
-                if data.get('result', ''):
-                    results[(row['workname'],
-                             row['constraints'])][row['attempt']].append(
-                                 '    %s' % data.get('result', ''))
-
-                for upgrade in data['order']:
-                    results[(row['workname'],
-                             row['constraints'])][row['attempt']].append(
-                                 '    %s: %s' %(upgrade,
-                                                data['details'][upgrade]))
-
-            results[(row['workname'],
-                     row['constraints'])][row['attempt']].append(
+            data = row['data'] or {'order': []}
+
+            if data.get('result', ''):
+                summaries[(row['workname'],
+                           row['constraints'])][row['attempt']].append(
+                               '    %s' % data.get('result', ''))
+
+            for upgrade in data['order']:
+                summaries[(row['workname'],
+                           row['constraints'])][row['attempt']].append(
+                               '    %s: %s' %(upgrade,
+                                              data['details'][upgrade]))
+
+            summaries[(row['workname'],
+                       row['constraints'])][row['attempt']].append(
                           '    Log URL: %s' % work.url())
-            results[(row['workname'],
-                     row['constraints'])][row['attempt']].append('')
+            summaries[(row['workname'],
+                       row['constraints'])][row['attempt']].append('')
 
         result = []
-        for workname, constraint in sorted(results.keys()):
-            attempt = max(results[(workname, constraint)].keys())
-            for line in results[(workname, constraint)][attempt]:
+        for workname, constraint in sorted(summaries.keys()):
+            attempt = max(summaries[(workname, constraint)].keys())
+            for line in summaries[(workname, constraint)][attempt]:
                 result.append(line)
 
         print 'Emailing %s #%s' %(ident, number)
@@ -238,8 +546,8 @@ if __name__ == '__main__':
                          NEW_RESULT_EMAIL
                          % {'results': '\n'.join(result)})
 
-        for workname, constraints in results:
-            for attempt in results[(workname, constraints)]:
+        for workname, constraints in summaries:
+            for attempt in summaries[(workname, constraints)]:
                 subcursor.execute('update work_queue set emailed = "y" where '
                                   'id="%s" and number=%s and workname="%s" '
                                   'and constraints="%s" and attempt>=%s;'
@@ -248,21 +556,11 @@ if __name__ == '__main__':
         subcursor.execute('commit;')
 
     # Write a log of all migrations we have ever seen
-    cursor.execute('select max(migration) from patchset_migrations;')
-    max_migration = cursor.fetchone()['max(migration)']
-    for i in range(max_migration - 10, max_migration + 1):
-        with open(os.path.join('/var/www/ci/migrations/nova',
-                               str(i) + '.html'),
-                  'w') as f:
-            sql = ('select distinct(id) from patchset_files '
-                   'where filename like '
-                   '"nova/db/sqlalchemy/migrate_repo/versions/%s_%%" '
-                   'order by id;'
-                   % i)
-            cursor.execute(sql)
-            counter = 1
-            for row in cursor:
-                f.write('<li><a href="http://review.openstack.org/#/q/%s,n,z">'
-                        '%s</a>' %(row['id'], row['id']))
-                counter += 1
-            f.write('<br/><br/>%d patchsets' %(counter - 1))
+    migrations = changed_migrations(since)
+    for migration in migrations:
+        write_migration_page(migration)
+
+    save_watermark(dump_started)
+    print ('%s Dumped in %.03f seconds: %d patchsets and %d migrations '
+           'changed' %(datetime.datetime.now(), time.time() - start,
+                       len(dirty), len(migrations)))
@@ -0,0 +1,214 @@
+#!/usr/bin/python
+
+"""On disk archive of gerrit events, written by eventlistener."""
+
+# Events for the current day are appended to output/<year>/<month>/<day>
+# through a buffered handle which is fsynced every few seconds. That file is
+# what the stream logger web servers publish and eventparser ingests.
+#
+# When the day rolls over, the day file is compressed into <day>.gz as a
+# series of independent gzip members ("segments") of SEGMENT_EVENTS events
+# each. <day>.idx has one JSON line per segment with its compressed byte
+# range, the time range of its events and a count of each event type, so
+# replay() can jump straight to the segments it needs. Plain day files are
+# kept for KEEP_PLAIN_DAYS so ingestion can still fetch them.
+
+
+import datetime
+import gzip
+import json
+import os
+import StringIO
+import time
+import zlib
+
+
+SEGMENT_EVENTS = 1000
+FSYNC_INTERVAL = 5
+KEEP_PLAIN_DAYS = 4
+
+
+def event_time(packet):
+    """The time an event happened, or 0 if it doesn't say."""
+
+    if 'eventCreatedOn' in packet:
+        return packet['eventCreatedOn']
+    return packet.get('patchSet', {}).get('createdOn', 0)
+
+
+def day_path(root, day):
+    return os.path.join(root, str(day.year), str(day.month), str(day.day))
+
+
+class ArchiveWriter(object):
+    def __init__(self, root='output', fsync_interval=FSYNC_INTERVAL):
+        self.root = root
+        self.fsync_interval = fsync_interval
+        self.day = None
+        self.f = None
+        self.last_sync = time.time()
+        self.unsynced = 0
+
+        # Catch up on any days which ended while we weren't running
+        compress_finished_days(self.root)
+
+    def _open(self, day):
+        self.close()
+        path = day_path(self.root, day)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.f = open(path, 'a', 64 * 1024)
+        self.day = day
+
+    def write(self, line):
+        today = datetime.date.today()
+        if today != self.day:
+            previous = self.day
+            self._open(today)
+            if previous:
+                compress_finished_days(self.root)
+
+        self.f.write('%s\n' % line)
+        self.unsynced += 1
+        if time.time() - self.last_sync > self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.f and self.unsynced:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        if self.f:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+
+def compress_day(path):
+    """Write path.gz and path.idx for a finished day file."""
+
+    index = []
+    out = StringIO.StringIO()
+
+    def finish_segment(lines, types, first, last):
+        start = out.tell()
+        with gzip.GzipFile(fileobj=out, mode='wb') as gz:
+            gz.write(''.join(lines))
+        index.append({'offset': start,
+                      'length': out.tell() - start,
+                      'first': first,
+                      'last': last,
+                      'events': len(lines),
+                      'types': types})
+
+    lines = []
+    types = {}
+    first = last = None
+    with open(path) as f:
+        for line in f:
+            try:
+                packet = json.loads(line)
+            except ValueError:
+                packet = {}
+
+            # Events without a time of their own inherit the previous one,
+            # which keeps each segment's time range meaningful.
+            ts = event_time(packet) or last or 0
+            if first is None:
+                first = ts
+            last = max(last or 0, ts)
+            event_type = packet.get('type', 'unknown')
+            types[event_type] = types.get(event_type, 0) + 1
+            lines.append(line)
+
+            if len(lines) >= SEGMENT_EVENTS:
+                finish_segment(lines, types, first, last)
+                lines = []
+                types = {}
+                first = None
+    if lines:
+        finish_segment(lines, types, first, last)
+
+    # The index is renamed into place last, as replay() trusts it
+    with open(path + '.gz.tmp', 'wb') as f:
+        f.write(out.getvalue())
+    os.rename(path + '.gz.tmp', path + '.gz')
+    with open(path + '.idx.tmp', 'w') as f:
+        for segment in index:
+            f.write('%s\n' % json.dumps(segment))
+    os.rename(path + '.idx.tmp', path + '.idx')
+    print ('%s Archived %s as %d segments'
+           %(datetime.datetime.now(), path, len(index)))
+
+
+def compress_finished_days(root):
+    """Compress every day before today, and expire old plain day files."""
+
+    today = datetime.date.today()
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.isdigit():
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                year, month = [int(x) for x in
+                               os.path.relpath(dirpath, root).split(os.sep)]
+                day = datetime.date(year, month, int(filename))
+            except ValueError:
+                continue
+            if day >= today:
+                continue
+
+            if not os.path.exists(path + '.idx'):
+                compress_day(path)
+            if (today - day).days > KEEP_PLAIN_DAYS:
+                os.unlink(path)
+
+
+def read_index(path):
+    with open(path + '.idx') as f:
+        return [json.loads(line) for line in f]
+
+
+def replay(root, day, after=None, types=None):
+    """Yield archived events for day, optionally filtered.
+
+    after is a unix time; only events at or after it are returned. types is
+    a list of event types to return. Only the segments which can contain
+    matching events are read and decompressed. Lines which aren't valid
+    JSON, such as one cut short by a crash, are skipped.
+    """
+
+    path = day_path(root, day)
+    skipped = 0
+    with open(path + '.gz', 'rb') as f:
+        for segment in read_index(path):
+            if after is not None and segment['last'] < after:
+                continue
+            if types is not None and not set(types) & set(segment['types']):
+                continue
+
+            f.seek(segment['offset'])
+            data = zlib.decompress(f.read(segment['length']),
+                                   16 + zlib.MAX_WBITS)
+            for line in data.split('\n'):
+                if not line:
+                    continue
+                try:
+                    packet = json.loads(line)
+                except ValueError:
+                    print '%s Skipping bad line: %s' %(datetime.datetime.now(),
+                                                       line[:100])
+                    skipped += 1
+                    continue
+                if types is not None and packet.get('type') not in types:
+                    continue
+                if after is not None and event_time(packet) < after:
+                    continue
+                yield packet
+    if skipped:
+        print '%s Skipped %d bad lines in %s' %(datetime.datetime.now(),
+                                                skipped, path)
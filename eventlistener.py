@@ -2,76 +2,293 @@
 
 # Listen to events from gerrit and log them to files. Run more than
 # one of these, as a failure will cause a gap in the event stream.
+#
+# Each listener keeps several stream-events connections open at once and
+# multiplexes them in one select() loop. An event seen on more than one
+# connection is only archived once, so a connection can drop and reconnect
+# without leaving a gap. Dead connections are noticed within seconds by TCP
+# and ssh keepalives, and are reopened with jittered exponential backoff.
+# Connections are opened in a thread of their own, so a slow or unreachable
+# server doesn't hold up the streams which are working.
 
+import argparse
+import collections
 import datetime
-import os
+import hashlib
 import paramiko
 import random
-import sys
+import select
+import socket
+import threading
 import time
 
+import eventarchive
+
 
 hostname = 'review.openstack.org'
 hostport = 29418
 username = 'mikalstill'
 keyfile = '/home/mikal/.ssh/id_gerrit'
 
+CONNECTIONS = 2
+READ_SIZE = 64 * 1024
+SELECT_TIMEOUT = 0.5
+STATS_INTERVAL = 300
+CONNECT_TIMEOUT = 30
 
-def stream_events():
-    last_event = time.time()
-    wait_time = 300 + random.randint(0, 300)
+# ssh keepalives make sure there is traffic for TCP to notice a dead peer
+# with. TCP keepalives cover a silently vanished peer.
+SSH_KEEPALIVE = 15
+TCP_KEEPIDLE = 15
+TCP_KEEPINTVL = 5
+TCP_KEEPCNT = 3
 
-    # Connect
-    transport = paramiko.Transport((hostname, hostport))
-    transport.start_client()
+# Backstop for connections which stay up but stop delivering events
+STALE_SECONDS = 900
 
-    # Authenticate with the key
-    key = paramiko.RSAKey.from_private_key_file(keyfile)
-    transport.auth_publickey(username, key)
+BACKOFF_MIN = 1
+BACKOFF_MAX = 300
+# How long a connection must stay up before its backoff starts again from
+# BACKOFF_MIN, so a server which accepts connections then drops them isn't
+# hammered
+STABLE_SECONDS = 60
 
-    channel = transport.open_session()
-    channel.exec_command('gerrit stream-events')
+# Recent events remembered to drop those delivered on several connections
+DEDUP_EVENTS = 10000
 
-    print '%s Connected' % datetime.datetime.now()
-    data = ''
 
-    try:
-        while True:
-            if not channel.recv_ready():
-                if time.time() - last_event > wait_time:
-                    print ('%s Possibly stale connection'
-                           % datetime.datetime.now())
-                    return
-                time.sleep(1)
-
-            else:
-                d = channel.recv(1024)
-                if not d:
-                    print '%s Connection closed' % datetime.datetime.now()
-                    return
-
-                last_event = time.time()
-                print '%s Read %d bytes' %(datetime.datetime.now(), len(d))
-                data += d
-
-                if data.find('\n') != -1:
-                    lines = data.split('\n')
-                    for line in lines[:-1]:
-                        now = datetime.datetime.now()
-                        path = os.path.join('output', str(now.year),
-                                            str(now.month))
-                        if not os.path.exists(path):
-                            os.makedirs(path)
-                        with open(os.path.join(path, str(now.day)), 'a') as f:
-                            f.write('%s\n' % line)
-
-                    data = lines[-1]
+class Stream(object):
+    """One gerrit stream-events connection, reopened as required."""
 
-    finally:
-        transport.close()
+    def __init__(self, name, host, port, user, key):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.user = user
+        self.key = key
+
+        self.transport = None
+        self.channel = None
+        self.connecting = None
+        self.attempt = None
+        self.data = ''
+        self.failures = 0
+        self.next_attempt = 0
+        self.connected_at = 0
+        self.last_data = 0
+        self.stats = {'bytes': 0, 'events': 0, 'reconnects': 0}
+
+    def connected(self):
+        return self.channel is not None
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    def connect(self):
+        """Start opening the connection. See finish_connect."""
+
+        self.connecting = threading.Thread(target=self._open,
+                                           name='connect %s' % self.name)
+        self.connecting.daemon = True
+        self.connecting.start()
+
+    def _open(self):
+        # Runs in the connecting thread, and only hands back its result
+        try:
+            self.attempt = self._handshake()
+        except Exception, e:
+            self.attempt = e
+
+    def _handshake(self):
+        sock = socket.create_connection((self.host, self.port),
+                                        CONNECT_TIMEOUT)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                            TCP_KEEPIDLE)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                            TCP_KEEPINTVL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                            TCP_KEEPCNT)
+
+        transport = paramiko.Transport(sock)
+        try:
+            transport.start_client(timeout=CONNECT_TIMEOUT)
+            key = paramiko.RSAKey.from_private_key_file(self.key)
+            transport.auth_publickey(self.user, key)
+            transport.set_keepalive(SSH_KEEPALIVE)
+
+            channel = transport.open_session()
+            channel.exec_command('gerrit stream-events')
+            channel.setblocking(0)
+        except Exception:
+            transport.close()
+            raise
+        return transport, channel
+
+    def finish_connect(self):
+        """Pick up the result of a finished connection attempt."""
+
+        if self.connecting is None or self.connecting.is_alive():
+            return
+        self.connecting = None
+        attempt = self.attempt
+        self.attempt = None
+
+        if isinstance(attempt, Exception):
+            print '%s %s failed to connect: %s' %(datetime.datetime.now(),
+                                                  self.name, attempt)
+            self.backoff()
+            return
+
+        if self.transport:
+            self.stats['reconnects'] += 1
+        self.transport, self.channel = attempt
+        self.data = ''
+        self.connected_at = time.time()
+        self.last_data = time.time()
+        print '%s %s connected' %(datetime.datetime.now(), self.name)
+
+    def disconnect(self, reason):
+        print '%s %s disconnected: %s' %(datetime.datetime.now(), self.name,
+                                         reason)
+        if self.channel:
+            self.channel.close()
+            self.channel = None
+        if self.transport:
+            self.transport.close()
+        self.backoff()
+
+    def backoff(self):
+        delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** self.failures)
+        self.failures += 1
+        # Jitter stops every connection retrying in lock step
+        self.next_attempt = time.time() + random.uniform(delay / 2.0, delay)
+
+    def read(self):
+        """Return the complete lines now available, or None if closed."""
+
+        try:
+            d = self.channel.recv(READ_SIZE)
+        except socket.timeout:
+            return []
+        if not d:
+            return None
+
+        self.last_data = time.time()
+        self.stats['bytes'] += len(d)
+        self.data += d
+        lines = self.data.split('\n')
+        self.data = lines.pop()
+        self.stats['events'] += len(lines)
+        return lines
+
+    def check(self):
+        """Return why the connection is dead, if it is."""
+
+        if self.failures and time.time() - self.connected_at > STABLE_SECONDS:
+            self.failures = 0
+
+        if not self.transport.is_active():
+            return 'transport no longer active'
+        if self.channel.exit_status_ready():
+            return 'stream-events exited'
+        if time.time() - self.last_data > STALE_SECONDS:
+            return 'no data for %d seconds' % STALE_SECONDS
+        return None
+
+
+class Deduplicator(object):
+    def __init__(self, size=DEDUP_EVENTS):
+        self.size = size
+        self.seen = collections.OrderedDict()
+        self.duplicates = 0
+
+    def is_new(self, line):
+        key = hashlib.sha1(line).digest()
+        if key in self.seen:
+            self.duplicates += 1
+            return False
+        self.seen[key] = True
+        if len(self.seen) > self.size:
+            self.seen.popitem(last=False)
+        return True
+
+
+def listen(streams, archive, dedup, once=False):
+    """Multiplex streams into archive. once returns after one pass."""
+
+    last_stats = time.time()
+    while True:
+        now = time.time()
+        for stream in streams:
+            if stream.connecting:
+                stream.finish_connect()
+            elif not stream.connected() and now >= stream.next_attempt:
+                stream.connect()
+
+        connected = [s for s in streams if s.connected()]
+        if connected:
+            readable = select.select(connected, [], [], SELECT_TIMEOUT)[0]
+        else:
+            readable = []
+            time.sleep(SELECT_TIMEOUT)
+
+        for stream in readable:
+            lines = stream.read()
+            if lines is None:
+                stream.disconnect('connection closed')
+                continue
+            for line in lines:
+                if line.strip() and dedup.is_new(line):
+                    archive.write(line)
+
+        for stream in connected:
+            if stream.connected():
+                reason = stream.check()
+                if reason:
+                    stream.disconnect(reason)
+
+        if not readable:
+            # Don't leave events sitting in the buffer while it is quiet
+            archive.sync()
+
+        if time.time() - last_stats > STATS_INTERVAL:
+            report(streams, dedup)
+            last_stats = time.time()
+
+        if once:
+            return
+
+
+def report(streams, dedup):
+    for stream in streams:
+        print ('%s %s: %d bytes, %d events, %d reconnects'
+               %(datetime.datetime.now(), stream.name,
+                 stream.stats['bytes'], stream.stats['events'],
+                 stream.stats['reconnects']))
+    print '%s %d duplicate events dropped' %(datetime.datetime.now(),
+                                             dedup.duplicates)
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=hostname)
+    parser.add_argument('--port', type=int, default=hostport)
+    parser.add_argument('--username', default=username)
+    parser.add_argument('--keyfile', default=keyfile)
+    parser.add_argument('--connections', type=int, default=CONNECTIONS,
+                        help='How many stream-events connections to keep '
+                             'open at once')
+    parser.add_argument('--output', default='output')
+    args = parser.parse_args()
+
     random.seed()
-    while True:
-        stream_events()
+    streams = [Stream('%s#%d' %(args.host, i), args.host, args.port,
+                      args.username, args.keyfile)
+               for i in range(args.connections)]
+    archive = eventarchive.ArchiveWriter(args.output)
+    try:
+        listen(streams, archive, Deduplicator())
+    finally:
+        archive.close()
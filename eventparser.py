@@ -4,177 +4,254 @@
 # These events are stored in a mysql database.
 
 import datetime
-import git
-import imp
 import json
 import MySQLdb
 import os
-import re
-import urllib
+import subprocess
+import time
 
+import gitcheckouts
+import ingest
+import pluginregistry
 import utils
-import workunit
 
 
-DIFF_FILENAME_RE = re.compile('^[\-\+][\-\+][\-\+] [ab]/(.*)$')
 FETCH_DAYS = 3
+# Patchset refs are fetched to here while their file lists are extracted
+FETCH_REF_PREFIX = 'refs/ci-fetch/'
+# A claim older than this belongs to a process which died, and is retaken
+CLAIM_SECONDS = 1800
 
 
 # Valid states:
 #   0: not fetched
+#   g: being fetched
 #   m: fetch skipped as git repo missing
+#   x: fetch failed, for example as the ref was deleted upstream
 #   f: fetched and converted into a list of changed files
+#   h: being offered to the plugins
 #   p: plugins run
+#
+# g and h are claims, taken with a conditional update so that eventparser
+# from cron and eventstream can run at once without both handling the same
+# patchset. patchsets.claimed (schema/007) records when they were taken.
 
 
-rechecks = {}
+def claim_patchset(cursor, row, state, claim):
+    """Move a patchset from state to claim, unless someone else has."""
 
+    cursor.execute('update patchsets set state="%s", claimed=NOW() '
+                   'where id="%s" and number=%d and (state="%s" or '
+                   '(state="%s" and claimed < NOW() - INTERVAL %d SECOND));'
+                   %(claim, row['id'], row['number'], state, claim,
+                     CLAIM_SECONDS))
+    claimed = cursor.rowcount == 1
+    cursor.execute('commit;')
+    return claimed
 
-def fetch_log_day(dt):
-    global rechecks
 
+def _claimable(state, claim):
+    """SQL matching patchsets in state, or with a stale claim."""
+
+    return ('(state="%s" or (state="%s" and '
+            'claimed < NOW() - INTERVAL %d SECOND))'
+            %(state, claim, CLAIM_SECONDS))
+
+
+def fetch_log_day(dt):
     new = 0
     cursor = utils.get_cursor()
 
-    for host in ['dfw', 'ord', 'syd']:
-        try:
-            print ('%s Fetching http://gerrit-stream-logger-%s.stillhq.com/'
-                   'output/%s/%s/%s'
-                   %(datetime.datetime.now(),
-                     host, dt.year, dt.month, dt.day))
-            remote = urllib.urlopen('http://gerrit-stream-logger-%s.'
-                                    'stillhq.com/output/%s/%s/%s'
-                                    %(host, dt.year, dt.month, dt.day))
-            for line in remote.readlines():
-                packet = json.loads(line)
-                if packet.get('type') == 'patchset-created':
-                    ts = packet['patchSet']['createdOn']
-                    ts = datetime.datetime.fromtimestamp(ts)
-                    cursor.execute('insert ignore into patchsets '
-                                   '(id, project, number, refurl, state, '
-                                   'subject, owner_name, url, timestamp) '
-                                   'values (%s, %s, %s, %s, 0, %s, %s, %s, '
-                                   '%s);',
-                                   (packet['change']['id'],
-                                    packet['change']['project'],
-                                    packet['patchSet']['number'],
-                                    packet['patchSet']['ref'],
-                                    utils.Normalize(
-                                        packet['change']['subject']),
-                                    utils.Normalize(
-                                        packet['change']['owner']['name']),
-                                    packet['change']['url'],
-                                    ts))
-                    new += cursor.rowcount
-                    cursor.execute('update patchsets set timestamp=%s where '
-                                   'id=%s and number=%s;',
-                                   (ts,
-                                    packet['change']['id'],
-                                    packet['patchSet']['number']))
-                    cursor.execute('commit;')
-
-                elif packet.get('type') == 'comment-added':
-                    if (packet.get('comment').startswith('recheck') or
-                        packet.get('comment').startswith('reverify')):
-                        # Confusingly, this is the timestamp for the comment
-                        ts = packet['patchSet']['createdOn']
-                        ts = datetime.datetime.fromtimestamp(ts)
-                        key = (packet['change']['id'],
-                               packet['patchSet']['number'])
-                        rechecks.setdefault(key, [])
-                        if not ts in rechecks[key]:
-                            rechecks[key].append(ts)
-
-        except Exception, e:
-            print '%s Error: %s' %(datetime.datetime.now(), e)
+    try:
+        new += ingest.ingest_day(cursor, dt.date())
+    except Exception, e:
+        print '%s Error: %s' %(datetime.datetime.now(), e)
 
-        try:
-            process_patchsets()
-            perform_git_fetches()
-            process_patchsets()
-        except Exception, e:
-            print '%s Error %s' %(datetime.datetime.now(), e)
+    try:
+        process_patchsets()
+        perform_git_fetches()
+        process_patchsets()
+    except Exception, e:
+        print '%s Error %s' %(datetime.datetime.now(), e)
 
     return new
 
 
-def perform_git_fetches():
-    fetches_performed = False
-    cursor = utils.get_cursor()
-    subcursor = utils.get_cursor()
-    cursor.execute('select * from patchsets where state="0" limit 25;')
-
-    for row in cursor:
-        fetches_performed = True
-        repo_path = os.path.join('/srv/git', row['project'])
+def _fetch_refs(project, repo_path, rows):
+    """Fetch the refs for rows in one go. Returns the rows fetched."""
+
+    url = 'https://review.openstack.org/%s' % project
+    refspecs = ['+%s:%s' %(row['refurl'], _local_ref(row['refurl']))
+                for row in rows]
+    print '%s Fetching %d refs for %s' %(datetime.datetime.now(), len(rows),
+                                         project)
+    if subprocess.call(['git', 'fetch', '-q', url] + refspecs,
+                       cwd=repo_path) == 0:
+        return rows
+
+    # One bad ref fails the whole fetch, so retry them one at a time
+    fetched = []
+    for row, refspec in zip(rows, refspecs):
+        if subprocess.call(['git', 'fetch', '-q', url, refspec],
+                           cwd=repo_path) == 0:
+            fetched.append(row)
+        else:
+            print '%s Failed to fetch %s' %(datetime.datetime.now(),
+                                            row['refurl'])
+    return fetched
+
+
+def _local_ref(refurl):
+    return refurl.replace('refs/', FETCH_REF_PREFIX, 1)
+
+
+def _changed_files(repo_path, ref):
+    """Stream the names of the files changed by the commit at ref."""
+
+    p = subprocess.Popen(['git', 'diff-tree', '--no-commit-id', '--root',
+                          '--name-only', '-r', '-z', ref],
+                         cwd=repo_path, stdout=subprocess.PIPE)
+    pending = ''
+    while True:
+        data = p.stdout.read(64 * 1024)
+        if not data:
+            break
+        pending += data
+        names = pending.split('\0')
+        pending = names.pop()
+        for name in names:
+            if name:
+                yield name
+    if pending:
+        yield pending
+    p.wait()
+
+
+def fetch_patchsets(rows, cursor):
+    """Fetch patchsets and record the files they change.
+
+    Returns (row, files) for each patchset fetched. Rows for projects we
+    have no git repo for are marked as skipped, and rows which couldn't be
+    fetched as failed, so they aren't selected again. Rows someone else has
+    claimed are left to them.
+    """
+
+    rows = [row for row in rows if claim_patchset(cursor, row, '0', 'g')]
+    by_project = {}
+    for row in rows:
+        by_project.setdefault(row['project'], []).append(row)
+
+    results = []
+    for project, rows in by_project.items():
+        repo_path = os.path.join('/srv/git', project)
         if not os.path.exists(repo_path):
-            utils.clone_git(row['project'])
+            utils.clone_git(project)
 
             if not os.path.exists(repo_path):
-                subcursor.execute('update patchsets set state="m" '
-                                  'where id="%s" and number=%d;'
-                                  %(row['id'], row['number']))
-                subcursor.execute('commit;')
+                for row in rows:
+                    cursor.execute('update patchsets set state="m" '
+                                   'where id="%s" and number=%d;'
+                                   %(row['id'], row['number']))
+                cursor.execute('commit;')
                 continue
 
-        repo = git.Repo(repo_path)
-        assert repo.bare == False
-        repo.git.checkout('master')
-        repo.git.pull()
-
-        files = {}
-        print '%s %s' %(datetime.datetime.now(), row['refurl'])
-        repo.git.fetch('https://review.openstack.org/%s' %row['project'],
-                       row['refurl'])
-        for line in repo.git.format_patch('-1', '--stdout',
-                                          'FETCH_HEAD').split('\n'):
-            m = DIFF_FILENAME_RE.match(line)
-            if m:
-                files[m.group(1)] = True
-        print '%s  %d files changed' %(datetime.datetime.now(), len(files))
-
-        for filename in files:
-            subcursor.execute('insert ignore into patchset_files '
-                              '(id, number, filename) values ("%s", %d, "%s");'
-                              %(row['id'], row['number'], filename))
-        subcursor.execute('update patchsets set state="f" '
-                          'where id="%s" and number=%d;'
-                          %(row['id'], row['number']))
-        subcursor.execute('commit;')
-
-    return fetches_performed
+        # Workers fetch into the same mirror, see gitcheckouts. Refreshing
+        # master is rate limited, so it happens at most once per pass.
+        gitcheckouts.refresh_mirror(project, lambda l: None)
+        with gitcheckouts.MirrorLock(project):
+            fetched = _fetch_refs(project, repo_path, rows)
+
+        for row in rows:
+            if not row in fetched:
+                cursor.execute('update patchsets set state="x" '
+                               'where id="%s" and number=%d;'
+                               %(row['id'], row['number']))
+        cursor.execute('commit;')
+
+        for row in fetched:
+            ref = _local_ref(row['refurl'])
+            files = sorted(set(_changed_files(repo_path, ref)))
+            subprocess.call(['git', 'update-ref', '-d', ref], cwd=repo_path)
+            print '%s %s %d files changed' %(datetime.datetime.now(),
+                                              row['refurl'], len(files))
+
+            if files:
+                args = []
+                for filename in files:
+                    args.extend([row['id'], row['number'], filename])
+                cursor.execute('insert ignore into patchset_files '
+                               '(id, number, filename) values %s;'
+                               % ', '.join(['(%s, %s, %s)'] * len(files)),
+                               args)
+            cursor.execute('update patchsets set state="f" '
+                           'where id="%s" and number=%d;'
+                           %(row['id'], row['number']))
+            cursor.execute('commit;')
+            results.append((row, files))
+    return results
+
+
+def perform_git_fetches():
+    """Fetch a batch of patchsets. Returns True if there was a batch.
+
+    Rows which can't be fetched leave state 0, so aren't selected again.
+    """
+
+    start = time.time()
+    cursor = utils.get_cursor()
+    cursor.execute('select * from patchsets where %s limit 25;'
+                   % _claimable('0', 'g'))
+    rows = list(cursor)
+
+    done = len(fetch_patchsets(rows, utils.get_cursor()))
+    if done:
+        elapsed = time.time() - start
+        print ('%s Fetched %d patchsets in %.02f seconds (%.01f per minute)'
+               %(datetime.datetime.now(), done, elapsed,
+                 done * 60.0 / max(elapsed, 0.001)))
+    return len(rows) > 0
+
+
+def handle_patchset(plugins, cursor, row, files):
+    """Offer a fetched patchset to the plugins, and mark it processed.
+
+    Returns False if someone else is handling it.
+    """
+
+    if not claim_patchset(cursor, row, 'f', 'h'):
+        return False
+
+    age = datetime.datetime.now() - row['timestamp']
+    if age.days < 2:
+        plugins.handle(row, files)
+
+    cursor.execute('update patchsets set state="p" '
+                   'where id="%s" and number=%d;'
+                   %(row['id'], row['number']))
+    cursor.execute('commit;')
+    return True
 
 
 def process_patchsets():
     cursor = utils.get_cursor()
 
-    # Load plugins
-    plugins = []
-    for ent in os.listdir('plugins'):
-        if ent[0] != '.' and ent.endswith('.py'):
-            plugin_info = imp.find_module(ent[:-3], ['plugins'])
-            plugins.append(imp.load_module(ent[:-3], *plugin_info))
+    plugins = pluginregistry.get_registry()
 
-    cursor.execute('select * from patchsets where state="f";')
+    cursor.execute('select * from patchsets where %s;'
+                   % _claimable('f', 'h'))
     subcursor = utils.get_cursor()
 
     for row in cursor:
+        files = []
         age = datetime.datetime.now() - row['timestamp']
         if age.days < 2:
-            files = []
-            subcursor.execute('select * from patchset_files where id="%s" and '
-                              'number=%d;'
+            subcursor.execute('select * from patchset_files where id="%s" '
+                              'and number=%d;'
                               %(row['id'], row['number']))
             for subrow in subcursor:
                 files.append(subrow['filename'])
 
-            for plugin in plugins:
-                plugin.Handle(row, files)
-
-        subcursor.execute('update patchsets set state="p" '
-                          'where id="%s" and number=%d;'
-                          %(row['id'], row['number']))
-        subcursor.execute('commit;')
+        handle_patchset(plugins, subcursor, row, files)
 
 
 if __name__ == '__main__':
@@ -194,18 +271,4 @@ if __name__ == '__main__':
     while perform_git_fetches():
         process_patchsets()
     process_patchsets()
-
-    cursor = utils.get_cursor()
-    for ident, number in rechecks:
-        for ts in rechecks[(ident, number)]:
-            cursor.execute('insert ignore into patchset_rechecks '
-                           '(id, number, timestamp) values ("%s", %s, %s);'
-                           %(ident, number, utils.datetime_as_sql(ts)))
-            if cursor.rowcount:
-                delta = datetime.datetime.now() - ts
-                if delta.days > 3:
-                    print 'Recheck ignored because it is older than three days'
-                else:
-                    print 'Recheck'
-                    workunit.recheck(cursor, ident, number)
-            cursor.execute('commit;')
+    pluginregistry.get_registry().report()
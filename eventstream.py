@@ -0,0 +1,276 @@
+#!/usr/bin/python
+
+"""Streaming mode for eventparser, fed by a local eventlistener."""
+
+# eventparser runs from cron, so a patchset is often tested minutes or hours
+# after it was uploaded. This instead follows the day files an eventlistener
+# on this machine is writing, and passes each event through three stages
+# running in their own threads:
+#
+#   read:   tail the day file and record patchsets and rechecks
+#   fetch:  fetch patchsets in batches and find the files they change
+#   handle: offer each patchset to the plugins, which enqueue work
+#
+# The stages are joined by bounded queues. When fetches fall behind the
+# reader blocks, so events wait in the day file rather than in memory. How
+# far the day file has been read is kept in ingest_checkpoints, under the
+# host name "local", so a restart picks up where it left off.
+#
+# Usage: eventstream.py [--archive <eventlistener output directory>]
+
+
+import argparse
+import datetime
+import json
+import os
+import Queue
+import select
+import threading
+import time
+
+import eventarchive
+import eventparser
+import inotify
+import ingest
+import pluginregistry
+import utils
+
+
+CHECKPOINT_HOST = 'local'
+READ_SIZE = 64 * 1024
+# How long to wait for the day file to grow if inotify is unavailable, and
+# how often to look for the next day's file
+POLL_INTERVAL = 0.5
+FETCH_QUEUE = 50
+HANDLE_QUEUE = 50
+FETCH_BATCH = 25
+
+
+class Event(object):
+    def __init__(self, row, arrived):
+        self.row = row
+        self.arrived = arrived
+        self.files = None
+
+
+def _next_day(root, day):
+    """The first day after day which has a file, if the listener is there."""
+
+    today = datetime.date.today()
+    while day < today:
+        day += datetime.timedelta(days=1)
+        if os.path.exists(eventarchive.day_path(root, day)):
+            return day
+    return None
+
+
+def follow(root, day, offset, idle):
+    """Yield (day, line, offset after line) as the listener writes lines.
+
+    idle() is called whenever we have caught up. The listener closes a day
+    file before it creates the next one, so once the next day's file exists
+    the current one is complete.
+    """
+
+    try:
+        notifier = inotify.Inotify()
+    except OSError, e:
+        print '%s inotify unavailable, polling: %s' %(datetime.datetime.now(),
+                                                       e)
+        notifier = None
+
+    f = None
+    pending = ''
+    last_read = False
+    try:
+        while True:
+            path = eventarchive.day_path(root, day)
+            if not f and os.path.exists(path):
+                f = open(path)
+                f.seek(offset)
+                if notifier:
+                    notifier.add_watch(path)
+
+            data = f.read(READ_SIZE) if f else ''
+            if data:
+                pending += data
+                lines = pending.split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    offset += len(line) + 1
+                    yield day, line, offset
+                continue
+
+            idle()
+            next_day = _next_day(root, day)
+            if next_day and not last_read:
+                # The listener may have written more before moving on
+                last_read = True
+                continue
+            if next_day:
+                if f:
+                    f.close()
+                    f = None
+                print '%s Following %s' %(datetime.datetime.now(),
+                                          eventarchive.day_path(root,
+                                                                next_day))
+                day = next_day
+                offset = 0
+                pending = ''
+                last_read = False
+                continue
+
+            if notifier and f:
+                if select.select([notifier], [], [], POLL_INTERVAL)[0]:
+                    notifier.read_events()
+            else:
+                time.sleep(POLL_INTERVAL)
+    finally:
+        if f:
+            f.close()
+        if notifier:
+            notifier.close()
+
+
+class Reader(object):
+    """Records events in the database and passes patchsets to fetch."""
+
+    def __init__(self, root, fetch_queue):
+        self.root = root
+        self.fetch_queue = fetch_queue
+        self.cursor = utils.get_cursor()
+        self.writer = None
+        self.pending = []
+
+    def _writer_for(self, day):
+        if not self.writer or self.writer.day != day:
+            self.flush()
+            self.writer = ingest.EventWriter(
+                self.cursor, day,
+                {CHECKPOINT_HOST: ingest.read_checkpoint(self.cursor,
+                                                         CHECKPOINT_HOST,
+                                                         day)})
+        return self.writer
+
+    def flush(self):
+        if not self.writer:
+            return
+        self.writer.flush()
+
+        for ident, number, arrived in self.pending:
+            # Patchsets already fetched, perhaps by eventparser, are skipped
+            self.cursor.execute('select * from patchsets where id=%s and '
+                                'number=%s and state="0";', (ident, number))
+            row = self.cursor.fetchone()
+            if not row:
+                continue
+
+            event = Event(row, arrived)
+            try:
+                self.fetch_queue.put_nowait(event)
+            except Queue.Full:
+                print ('%s Fetches are behind, pausing the reader'
+                       % datetime.datetime.now())
+                self.fetch_queue.put(event)
+        self.pending = []
+
+    def run(self):
+        day = datetime.date.today()
+        offset = ingest.read_checkpoint(self.cursor, CHECKPOINT_HOST, day)
+        for day, line, offset in follow(self.root, day, offset, self.flush):
+            writer = self._writer_for(day)
+            try:
+                packet = json.loads(line) if line.strip() else {}
+            except ValueError:
+                print '%s Skipping bad line: %s' %(datetime.datetime.now(),
+                                                   line[:100])
+                packet = {}
+
+            if packet.get('type') == 'patchset-created':
+                writer.add_patchset(packet)
+                self.pending.append((packet['change']['id'],
+                                     packet['patchSet']['number'],
+                                     time.time()))
+            elif (packet.get('type') == 'comment-added' and
+                  ingest.is_recheck(packet)):
+                writer.add_recheck(packet)
+
+            writer.advance(CHECKPOINT_HOST, offset)
+            if len(self.pending) >= ingest.BATCH_SIZE:
+                self.flush()
+
+
+def fetch_stage(fetch_queue, handle_queue):
+    cursor = utils.get_cursor()
+    while True:
+        events = [fetch_queue.get()]
+        while len(events) < FETCH_BATCH:
+            try:
+                events.append(fetch_queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        by_key = {}
+        for event in events:
+            by_key[(event.row['id'], event.row['number'])] = event
+
+        try:
+            fetched = eventparser.fetch_patchsets(
+                [event.row for event in events], cursor)
+        except Exception, e:
+            # The patchsets are picked up again once their claims expire
+            print '%s Error fetching: %s' %(datetime.datetime.now(), e)
+            continue
+
+        for row, files in fetched:
+            event = by_key[(row['id'], row['number'])]
+            event.files = files
+            handle_queue.put(event)
+
+
+def handle_stage(handle_queue):
+    cursor = utils.get_cursor()
+    while True:
+        event = handle_queue.get()
+        try:
+            plugins = pluginregistry.get_registry()
+            if not eventparser.handle_patchset(plugins, cursor, event.row,
+                                               event.files):
+                continue
+        except Exception, e:
+            print '%s Error handling %s #%s: %s' %(datetime.datetime.now(),
+                                                   event.row['id'],
+                                                   event.row['number'], e)
+            continue
+
+        created = time.mktime(event.row['timestamp'].timetuple())
+        print ('%s Handled %s #%s %.02f seconds after it was read, %.02f '
+               'seconds after it was uploaded'
+               %(datetime.datetime.now(), event.row['id'],
+                 event.row['number'], time.time() - event.arrived,
+                 time.time() - created))
+
+
+def _start(target, *args):
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--archive', default='output',
+                        help='The directory eventlistener writes to')
+    args = parser.parse_args()
+
+    # Anything left over from before we started goes through the batch path
+    while eventparser.perform_git_fetches():
+        eventparser.process_patchsets()
+    eventparser.process_patchsets()
+
+    fetch_queue = Queue.Queue(FETCH_QUEUE)
+    handle_queue = Queue.Queue(HANDLE_QUEUE)
+    _start(fetch_stage, fetch_queue, handle_queue)
+    _start(handle_stage, handle_queue)
+    Reader(args.archive, fetch_queue).run()
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+"""Per job git checkouts sharing one object store per project."""
+
+# /srv/git/<project> is a mirror of the upstream repository. It is only
+# fetched into, never checked out by jobs, and at most once per refresh
+# interval. Each job gets a "git clone --shared" of the mirror, which
+# borrows the mirror's objects instead of copying them, so creating a
+# checkout costs little more than writing out the working tree.
+#
+# The mirror's remote tracking branches are exposed in each job checkout as
+# upstream/*, with local master and stable/grizzly branches made from them.
+
+
+import datetime
+import fcntl
+import os
+import shutil
+import subprocess
+import time
+
+
+GIT_DIR = '/srv/git'
+REVIEW_URL = 'https://review.openstack.org/%s'
+DEFAULT_REFRESH_INTERVAL = 300
+
+# Branches jobs expect to find in their checkout
+LOCAL_BRANCHES = ['master', 'stable/grizzly']
+
+
+class MirrorLock(object):
+    """Serializes fetches into a project's mirror."""
+
+    def __init__(self, project):
+        self.path = os.path.join(GIT_DIR, project + '.lock')
+
+    def __enter__(self):
+        self.f = open(self.path, 'w')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+
+def run(cmd, cwd, log):
+    """Run a git command, passing each output line to log."""
+
+    log('+ %s' % ' '.join(cmd))
+    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT)
+    output = []
+    l = p.stdout.readline()
+    while l:
+        log(l.rstrip())
+        output.append(l)
+        l = p.stdout.readline()
+    p.wait()
+    return p.returncode, output
+
+
+def refresh_mirror(project, log, interval=DEFAULT_REFRESH_INTERVAL):
+    """Fetch upstream into the mirror, unless that happened recently."""
+
+    mirror = os.path.join(GIT_DIR, project)
+    stamp = mirror + '.refreshed'
+    with MirrorLock(project):
+        try:
+            age = time.time() - os.stat(stamp).st_mtime
+        except OSError:
+            age = None
+
+        if age is not None and age < interval:
+            log('Mirror of %s refreshed %d seconds ago, not fetching'
+                %(project, age))
+            return
+
+        returncode, _ = run(['git', 'fetch', 'origin'], mirror, log)
+        if returncode == 0:
+            with open(stamp, 'w') as f:
+                f.write('%s\n' % datetime.datetime.now())
+
+
+def _disk_usage_kb(path):
+    p = subprocess.Popen(['du', '-sk', path], stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    try:
+        return int(out.split()[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+def _merge_conflicts(checkout, base, head):
+    """Would applying head on top of base conflict? Doesn't touch the tree."""
+
+    p = subprocess.Popen(['git', 'merge-tree', '--write-tree',
+                          '--no-messages', base, head],
+                         cwd=checkout, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    p.communicate()
+    if p.returncode in (0, 1):
+        return p.returncode == 1
+    if p.returncode != 129:
+        # Some other failure, such as a missing commit
+        return True
+
+    # Older git only has the three argument form, which prints conflicts
+    # inline rather than setting the exit code.
+    p = subprocess.Popen(['git', 'merge-base', base, head], cwd=checkout,
+                         stdout=subprocess.PIPE)
+    merge_base = p.communicate()[0].strip()
+    p = subprocess.Popen(['git', 'merge-tree', merge_base, base, head],
+                         cwd=checkout, stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    return out.find('\n+<<<<<<<') != -1
+
+
+def find_base(checkout, head, max_rewind, log):
+    """Find the newest master~N which head applies to cleanly.
+
+    Returns (rewind, probes), with rewind None if nothing in range works.
+    master itself is tried first. If it conflicts, the range is bisected on
+    the assumption that once an old enough base applies cleanly, older ones
+    do too, and the answer is checked before being returned.
+    """
+
+    probes = [0]
+
+    def conflicts(rewind):
+        probes[0] += 1
+        conflict = _merge_conflicts(checkout, 'master~%d' % rewind, head)
+        log('Probe master~%d: %s' %(rewind,
+                                    'conflict' if conflict else 'clean'))
+        return conflict
+
+    if not conflicts(0):
+        return 0, probes[0]
+
+    p = subprocess.Popen(['git', 'rev-list', '--count', 'master'],
+                         cwd=checkout, stdout=subprocess.PIPE)
+    available = int(p.communicate()[0].strip() or 0)
+    low, high = 1, min(max_rewind, available) - 1
+    if high < low or conflicts(high):
+        return None, probes[0]
+
+    # Invariant: master~high is clean
+    while low < high:
+        mid = (low + high) / 2
+        if conflicts(mid):
+            low = mid + 1
+        else:
+            high = mid
+    return high, probes[0]
+
+
+def create_checkout(project, refurl, checkout, log, max_rewind=10,
+                    interval=DEFAULT_REFRESH_INTERVAL):
+    """Create checkout with trunk and target branches for refurl.
+
+    trunk is the newest of master~0 .. master~(max_rewind - 1) which the
+    patchset rebases onto cleanly. The candidates are checked in place with
+    git merge-tree, so the checkout and fetch only happen once. Returns True
+    if no candidate worked.
+    """
+
+    start = time.time()
+    mirror = os.path.join(GIT_DIR, project)
+    refresh_mirror(project, log, interval=interval)
+
+    if os.path.exists(checkout):
+        shutil.rmtree(checkout)
+    parent = os.path.dirname(checkout)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    run(['git', 'clone', '-q', '--shared', '--no-checkout', mirror,
+         checkout], None, log)
+    run(['git', 'fetch', '-q', 'origin',
+         '+refs/remotes/origin/*:refs/remotes/upstream/*'], checkout, log)
+    for branch in LOCAL_BRANCHES:
+        # update-ref, as branch -f refuses to move the (unpopulated) HEAD
+        run(['git', 'update-ref', 'refs/heads/%s' % branch,
+             'upstream/%s' % branch], checkout, log)
+    run(['git', 'fetch', REVIEW_URL % project, refurl], checkout, log)
+    run(['git', 'branch', 'target', 'FETCH_HEAD'], checkout, log)
+
+    rewind, probes = find_base(checkout, 'target', max_rewind, log)
+    if rewind is None:
+        log('Git merge failure with all bases from master to master~%d '
+            '(%d probes)' %(max_rewind - 1, probes))
+        return True
+
+    p = subprocess.Popen(['git', 'rev-parse', 'master~%d' % rewind],
+                         cwd=checkout, stdout=subprocess.PIPE)
+    base = p.communicate()[0].strip()
+    log('Chose base master~%d (%s) after %d probes' %(rewind, base, probes))
+
+    run(['git', 'checkout', '-b', 'trunk', base], checkout, log)
+    run(['git', 'checkout', 'target'], checkout, log)
+
+    # We need to rebase to pull in deltas between trunk and the point where
+    # this patch diverged from trunk.
+    _, output = run(['git', 'rebase', 'trunk'], checkout, log)
+    conflict = False
+    for l in output:
+        if l.find('CONFLICT') != -1:
+            conflict = True
+
+    # The job log is parsed for this line, see workunit.CHECKOUT_RE
+    log('Git checkout took %.02f seconds and uses %d KB'
+        %(time.time() - start, _disk_usage_kb(checkout)))
+    return conflict
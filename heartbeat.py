@@ -0,0 +1,54 @@
+#!/usr/bin/python
+
+"""Keep the lease on a running work unit alive."""
+
+# A worker holds a lease on each work unit it has claimed. The lease is
+# renewed by refreshing work_queue.heartbeat from a dedicated thread, so it
+# no longer depends on the job producing log output. Units whose lease runs
+# out are requeued as a new attempt by workunit.reap_expired_leases().
+
+
+import datetime
+import MySQLdb
+import threading
+
+import dbpool
+import utils
+
+
+DEFAULT_LEASE_SECONDS = 600
+
+
+def lease_seconds():
+    return utils.get_config().get('lease_seconds', DEFAULT_LEASE_SECONDS)
+
+
+class Heartbeat(threading.Thread):
+    def __init__(self, work, interval=None):
+        super(Heartbeat, self).__init__(name='heartbeat')
+        self.daemon = True
+
+        self.work = work
+        if interval is None:
+            # Renew several times per lease so one slow write doesn't lose it
+            interval = max(5, lease_seconds() / 4)
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def run(self):
+        cursor = None
+        while not self.stopping.wait(self.interval):
+            try:
+                if cursor is None:
+                    cursor = utils.get_cursor()
+                if not self.work.heartbeat(cursor):
+                    print ('%s Lease lost, the unit has been requeued'
+                           % datetime.datetime.now())
+                    return
+            except (MySQLdb.Error, dbpool.PoolExhausted), e:
+                print '%s Heartbeat failed: %s' %(datetime.datetime.now(), e)
+                cursor = None
@@ -0,0 +1,317 @@
+#!/usr/bin/python
+
+"""Incremental ingestion of the gerrit stream logger day files."""
+
+# Each logger serves one file per day, which only ever grows. We remember
+# how many bytes of each file have been ingested (ingest_checkpoints) and
+# ask for the rest with an HTTP Range request. Events are parsed as they
+# stream in and written in batches, with the checkpoint committed in the
+# same transaction as the patchsets before it. Rechecks before it are queued
+# first, so a crash can only lead to them being seen again, which is
+# harmless, rather than lost.
+#
+# We run several loggers so there are no gaps, which means most events
+# arrive several times. The loggers' streams are merged by event time and
+# duplicates dropped here, rather than by the database one row at a time.
+
+
+import collections
+import datetime
+import heapq
+import json
+import urllib2
+
+import eventarchive
+import utils
+import workunit
+
+
+LOGGERS = ['dfw', 'ord', 'syd']
+LOG_URL = ('http://gerrit-stream-logger-%(host)s.stillhq.com/'
+           'output/%(year)s/%(month)s/%(day)s')
+BATCH_SIZE = 500
+# Events remembered for deduplication across loggers
+DEDUP_KEYS = 100000
+READ_SIZE = 64 * 1024
+
+
+def log_url(host, day):
+    return LOG_URL % {'host': host,
+                      'year': day.year,
+                      'month': day.month,
+                      'day': day.day}
+
+
+def read_checkpoint(cursor, host, day):
+    cursor.execute('select offset from ingest_checkpoints where host=%s and '
+                   'day=%s;', (host, day))
+    row = cursor.fetchone()
+    if not row:
+        return 0
+    return row['offset']
+
+
+def stream_lines(host, day, offset):
+    """Yield (line, offset after line) for complete lines past offset."""
+
+    url = log_url(host, day)
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
+
+    try:
+        remote = urllib2.urlopen(request)
+    except urllib2.HTTPError, e:
+        if e.code == 416:
+            # Nothing new since the checkpoint
+            return
+        raise
+
+    skip = 0
+    if offset and remote.getcode() != 206:
+        # The server ignored the Range header
+        skip = offset
+    print '%s Fetching %s from byte %d' %(datetime.datetime.now(), url,
+                                          offset)
+
+    pending = ''
+    while True:
+        data = remote.read(READ_SIZE)
+        if not data:
+            break
+        if skip:
+            dropped = min(skip, len(data))
+            data = data[dropped:]
+            skip -= dropped
+            if not data:
+                continue
+
+        pending += data
+        lines = pending.split('\n')
+        # A trailing partial line is left for the next run
+        pending = lines.pop()
+        for line in lines:
+            offset += len(line) + 1
+            yield line, offset
+
+
+class EventWriter(object):
+    """Batches patchset-created events and checkpoints into the database."""
+
+    def __init__(self, cursor, day, offsets):
+        self.cursor = cursor
+        self.day = day
+        self.checkpoints = dict(offsets)
+        self.offsets = dict(offsets)
+        self.patchsets = []
+        self.rechecks = {}
+        self.new = 0
+
+    def add_patchset(self, packet):
+        ts = datetime.datetime.fromtimestamp(packet['patchSet']['createdOn'])
+        self.patchsets.append((packet['change']['id'],
+                               packet['change']['project'],
+                               packet['patchSet']['number'],
+                               packet['patchSet']['ref'],
+                               utils.Normalize(packet['change']['subject']),
+                               utils.Normalize(
+                                   packet['change']['owner']['name']),
+                               packet['change']['url'],
+                               ts))
+        if len(self.patchsets) >= BATCH_SIZE:
+            self.flush()
+
+    def add_recheck(self, packet):
+        record_recheck(self.rechecks, packet)
+
+    def advance(self, host, offset):
+        self.offsets[host] = offset
+
+    def flush(self):
+        moved = [host for host in sorted(self.offsets)
+                 if self.offsets[host] != self.checkpoints.get(host)]
+        if not self.patchsets and not self.rechecks and not moved:
+            return
+
+        if self.patchsets:
+            values = ', '.join(['(%s, %s, %s, %s, 0, %s, %s, %s, %s)']
+                               * len(self.patchsets))
+            args = sum([list(p) for p in self.patchsets], [])
+            self.cursor.execute('insert ignore into patchsets '
+                                '(id, project, number, refurl, state, '
+                                'subject, owner_name, url, timestamp) '
+                                'values %s;' % values, args)
+            self.new += self.cursor.rowcount
+
+            # Later events for a patchset win, as they did when each event
+            # was an insert followed by an update.
+            self.cursor.execute('insert into patchsets '
+                                '(id, project, number, refurl, state, '
+                                'subject, owner_name, url, timestamp) '
+                                'values %s on duplicate key update '
+                                'timestamp=values(timestamp);' % values, args)
+            self.patchsets = []
+
+        if self.rechecks:
+            queue_rechecks(self.cursor, self.rechecks)
+            self.rechecks = {}
+
+        for host in moved:
+            self.cursor.execute('insert into ingest_checkpoints '
+                                '(host, day, offset, updated) '
+                                'values (%s, %s, %s, NOW()) '
+                                'on duplicate key update '
+                                'offset=values(offset), updated=NOW();',
+                                (host, self.day, self.offsets[host]))
+        self.cursor.execute('commit;')
+        self.checkpoints = dict(self.offsets)
+
+
+def record_recheck(rechecks, packet):
+    # Confusingly, this is the timestamp for the comment
+    ts = packet['patchSet']['createdOn']
+    ts = datetime.datetime.fromtimestamp(ts)
+    key = (packet['change']['id'], packet['patchSet']['number'])
+    rechecks.setdefault(key, [])
+    if not ts in rechecks[key]:
+        rechecks[key].append(ts)
+
+
+def queue_rechecks(cursor, rechecks):
+    for ident, number in rechecks:
+        for ts in rechecks[(ident, number)]:
+            cursor.execute('insert ignore into patchset_rechecks '
+                           '(id, number, timestamp) values ("%s", %s, %s);'
+                           %(ident, number, utils.datetime_as_sql(ts)))
+            if cursor.rowcount:
+                delta = datetime.datetime.now() - ts
+                if delta.days > 3:
+                    print 'Recheck ignored because it is older than three days'
+                else:
+                    print 'Recheck'
+                    workunit.recheck(cursor, ident, number)
+            cursor.execute('commit;')
+
+
+def is_recheck(packet):
+    comment = packet.get('comment') or ''
+    return comment.startswith('recheck') or comment.startswith('reverify')
+
+
+def event_key(packet):
+    """A key which is the same for an event no matter which logger saw it."""
+
+    person = (packet.get('author') or packet.get('uploader') or
+              packet.get('submitter') or {})
+    return (packet.get('type'),
+            packet.get('change', {}).get('id'),
+            packet.get('patchSet', {}).get('number'),
+            eventarchive.event_time(packet),
+            person.get('username') or person.get('email') or
+            person.get('name'),
+            # Two comments by the same person on the same patchset in the
+            # same second are different events
+            packet.get('comment'))
+
+
+class Deduplicator(object):
+    """Drops events already seen from another logger.
+
+    Remembers the last max_keys events, and which loggers delivered each
+    one, so it can report how much each logger overlapped with the others
+    and how many events it missed.
+    """
+
+    def __init__(self, hosts, max_keys=DEDUP_KEYS):
+        self.hosts = hosts
+        self.max_keys = max_keys
+        self.seen = collections.OrderedDict()
+        self.stats = {}
+        for host in hosts:
+            self.stats[host] = {'events': 0, 'duplicates': 0, 'missed': 0,
+                                'only_here': 0}
+
+    def is_new(self, host, packet):
+        key = event_key(packet)
+        self.stats[host]['events'] += 1
+        if key in self.seen:
+            self.seen[key].add(host)
+            self.stats[host]['duplicates'] += 1
+            return False
+
+        self.seen[key] = set([host])
+        if len(self.seen) > self.max_keys:
+            self._account(self.seen.popitem(last=False)[1])
+        return True
+
+    def _account(self, delivered_by):
+        for host in self.hosts:
+            if host not in delivered_by:
+                self.stats[host]['missed'] += 1
+        if len(delivered_by) == 1:
+            for host in delivered_by:
+                self.stats[host]['only_here'] += 1
+
+    def report(self):
+        for delivered_by in self.seen.values():
+            self._account(delivered_by)
+        self.seen.clear()
+
+        for host in self.hosts:
+            stats = self.stats[host]
+            print ('%s Logger %s: %d events, %d duplicates of other loggers, '
+                   '%d only seen here, %d missed'
+                   %(datetime.datetime.now(), host, stats['events'],
+                     stats['duplicates'], stats['only_here'],
+                     stats['missed']))
+
+
+def host_events(host, day, offset):
+    """Yield (time, host, packet, offset after line) from one logger.
+
+    A logger which can't be reached just ends its stream, so the others can
+    still be ingested.
+    """
+
+    try:
+        for line, end in stream_lines(host, day, offset):
+            try:
+                packet = json.loads(line) if line.strip() else {}
+            except ValueError:
+                print '%s Skipping bad line: %s' %(datetime.datetime.now(),
+                                                   line[:100])
+                packet = {}
+            yield eventarchive.event_time(packet), host, packet, end
+    except Exception, e:
+        print '%s Error fetching from %s: %s' %(datetime.datetime.now(),
+                                                host, e)
+
+
+def ingest_day(cursor, day, hosts=LOGGERS):
+    """Ingest new events for a day from all loggers. Returns new patchsets.
+
+    The loggers' streams are merged by event time and duplicates dropped
+    before anything reaches the database.
+    """
+
+    offsets = {}
+    for host in hosts:
+        offsets[host] = read_checkpoint(cursor, host, day)
+
+    writer = EventWriter(cursor, day, offsets)
+    dedup = Deduplicator(hosts)
+    streams = [host_events(host, day, offsets[host]) for host in hosts]
+    try:
+        for _, host, packet, end in heapq.merge(*streams):
+            writer.advance(host, end)
+            if not packet or not dedup.is_new(host, packet):
+                continue
+
+            if packet.get('type') == 'patchset-created':
+                writer.add_patchset(packet)
+            elif packet.get('type') == 'comment-added' and is_recheck(packet):
+                writer.add_recheck(packet)
+    finally:
+        writer.flush()
+        dedup.report()
+    return writer.new
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+"""Minimal ctypes binding for Linux inotify."""
+
+# Plain files are always reported as readable by poll() and epoll, so tailing
+# a log file needs inotify to find out when it has actually grown.
+
+
+import ctypes
+import ctypes.util
+import os
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 02000000
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _libc
+
+
+class Inotify(object):
+    def __init__(self):
+        libc = _get_libc()
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not supported on this platform')
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=IN_MODIFY):
+        wd = _get_libc().inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read_events(self):
+        """Return a list of (watch descriptor, mask) for pending events."""
+
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            events.append((wd, mask))
+            offset += EVENT_HEADER.size + length
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
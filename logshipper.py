@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+"""Ship work unit log lines to the database in the background."""
+
+# WorkUnit.log() hands lines to a LogShipper, which buffers them and writes
+# each flush as a log segment, see logstore. If the database can't be reached
+# the lines are spooled to a local file and replayed, in order, on the next
+# successful flush.
+#
+# A run of identical lines at the end of a flush is held back, so repeats
+# such as heartbeats collapse into one record rather than one per flush.
+
+
+import datetime
+import json
+import MySQLdb
+import os
+import threading
+
+import dbpool
+import logstore
+import utils
+
+
+FLUSH_LINES = 1000
+FLUSH_INTERVAL = 30.0
+# The longest a run of repeated lines is held back for
+MAX_HOLD = 300
+SPOOL_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+class LogShipper(threading.Thread):
+    def __init__(self, work, flush_lines=FLUSH_LINES,
+                 flush_interval=FLUSH_INTERVAL):
+        super(LogShipper, self).__init__(name='logshipper')
+        self.daemon = True
+
+        self.work = work
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+
+        self.cond = threading.Condition()
+        self.buffer = []
+        self.held = []
+        self.stopping = False
+
+        self.logpath = work.log_path()
+        logdir = os.path.dirname(self.logpath)
+        if not os.path.exists(logdir):
+            os.makedirs(logdir)
+        self.logfile = open(self.logpath, 'a+')
+        self.spoolpath = self.logpath + '.spool'
+
+        self.cursor = None
+        self.pushed = 0
+        self.spooled = 0
+
+    def add(self, timestamp, line):
+        with self.cond:
+            self.buffer.append((timestamp, line))
+            if len(self.buffer) >= self.flush_lines:
+                self.cond.notify()
+
+    def stop(self):
+        """Flush everything buffered and wait for the thread to finish."""
+
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.join()
+        self.logfile.close()
+        print ('%s Shipped %d log lines, %d spooled for later'
+               %(datetime.datetime.now(), self.pushed, self.spooled))
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.stopping and len(self.buffer) < self.flush_lines:
+                    self.cond.wait(self.flush_interval)
+                entries = self.buffer
+                self.buffer = []
+                stopping = self.stopping
+
+            if entries:
+                self._write_local(entries)
+
+            # Already written locally, but not yet shipped
+            entries = self.held + entries
+            self.held = []
+            if entries and not stopping:
+                entries, self.held = logstore.split_trailing_run(entries)
+                age = datetime.datetime.now() - self.held[0][0]
+                if age.seconds >= MAX_HOLD:
+                    entries += self.held
+                    self.held = []
+
+            if entries:
+                self._ship(entries)
+            elif os.path.exists(self.spoolpath):
+                self._ship([])
+
+            if stopping:
+                with self.cond:
+                    if not self.buffer:
+                        return
+
+    def _write_local(self, entries):
+        for timestamp, log in entries:
+            self.logfile.write('%s %s\n' %(timestamp, log.rstrip()))
+        self.logfile.flush()
+
+    def _ship(self, entries):
+        try:
+            if self.cursor is None:
+                self.cursor = utils.get_cursor()
+            self._replay_spool()
+            if entries:
+                self.work.append_log_segment(self.cursor, entries)
+                self.pushed += len(entries)
+        except (MySQLdb.Error, dbpool.PoolExhausted), e:
+            print '%s Log shipping failed: %s' %(datetime.datetime.now(), e)
+            self.cursor = None
+            self._spool(entries)
+
+    def _spool(self, entries):
+        w = self.work
+        unit = [w.ident, w.number, w.workname, w.worker, w.constraints,
+                w.attempt]
+        with open(self.spoolpath, 'a') as f:
+            for timestamp, log in entries:
+                f.write('%s\n'
+                        % json.dumps({'unit': unit,
+                                      'timestamp': timestamp.strftime(
+                                          SPOOL_TIMESTAMP_FORMAT),
+                                      # Latin-1 round trips arbitrary bytes
+                                      'log': log.decode('latin-1')}))
+        self.spooled += len(entries)
+
+    def _replay_spool(self):
+        if not os.path.exists(self.spoolpath):
+            return
+
+        entries = [(timestamp, log)
+                   for _, timestamp, log in read_spool(self.spoolpath)]
+
+        # Only remove the spool once its contents are safely in the database.
+        # If this insert fails the caller spools the new entries after the
+        # old ones, which keeps the lines in order.
+        self.work.append_log_segment(self.cursor, entries)
+        os.unlink(self.spoolpath)
+        self.pushed += len(entries)
+        self.spooled -= len(entries)
+        print ('%s Replayed %d spooled log lines'
+               %(datetime.datetime.now(), len(entries)))
+
+
+def read_spool(path):
+    """Yield (unit, timestamp, log) for each line in a spool file."""
+
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            yield (tuple(entry['unit']),
+                   datetime.datetime.strptime(entry['timestamp'],
+                                              SPOOL_TIMESTAMP_FORMAT),
+                   entry['log'].encode('latin-1'))
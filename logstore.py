@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+"""Compressed, segmented storage for work unit logs."""
+
+# A job's log is stored as a series of append-only segments in
+# work_log_segments, rather than a row per line in work_logs. Each segment
+# is a zlib compressed run of records, one JSON list per line:
+#
+#   [timestamp, count, last timestamp, log line]
+#
+# Consecutive identical lines (heartbeats, pip progress and so on) are
+# collapsed into one record with a count. Alongside the data, each segment
+# row records the job, its sequence number, and the range of lines and times
+# it covers, so readers can fetch part of a log without decompressing the
+# rest.
+#
+# Logs written before segments existed are still read from work_logs until
+# they are converted with "logstore.py migrate".
+
+
+import datetime
+import json
+import sys
+import zlib
+
+import utils
+
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Lines per segment when converting work_logs
+MIGRATE_SEGMENT_LINES = 1000
+# Most log text in one segment. Each segment is one insert, so this keeps
+# even an incompressible segment well under max_allowed_packet.
+SEGMENT_BYTES = 512 * 1024
+
+
+def _job_where(work):
+    return ('id="%s" and number=%s and workname="%s" and constraints="%s" '
+            'and attempt=%s'
+            %(work.ident, work.number, work.workname, work.constraints,
+              work.attempt))
+
+
+def collapse(entries):
+    """Turn (timestamp, log) pairs into run length collapsed records."""
+
+    records = []
+    for timestamp, log in entries:
+        log = log.rstrip()
+        if records and records[-1][3] == log:
+            records[-1][1] += 1
+            records[-1][2] = timestamp
+        else:
+            records.append([timestamp, 1, timestamp, log])
+    return records
+
+
+def split_trailing_run(entries):
+    """Split (timestamp, log) pairs before the run of repeats at the end.
+
+    The writer holds the trailing run back, so it can grow and be stored as
+    one record instead of one per flush.
+    """
+
+    if not entries:
+        return entries, []
+    last = entries[-1][1].rstrip()
+    start = len(entries) - 1
+    while start > 0 and entries[start - 1][1].rstrip() == last:
+        start -= 1
+    return entries[:start], entries[start:]
+
+
+def encode(records):
+    lines = []
+    for timestamp, count, last_timestamp, log in records:
+        lines.append(json.dumps([timestamp.strftime(TIMESTAMP_FORMAT), count,
+                                 last_timestamp.strftime(TIMESTAMP_FORMAT),
+                                 # Latin-1 round trips arbitrary bytes
+                                 log.decode('latin-1')]))
+    return zlib.compress('\n'.join(lines))
+
+
+def decode(data):
+    for line in zlib.decompress(data).split('\n'):
+        timestamp, count, last_timestamp, log = json.loads(line)
+        yield {'timestamp': datetime.datetime.strptime(timestamp,
+                                                       TIMESTAMP_FORMAT),
+               'count': count,
+               'last_timestamp': datetime.datetime.strptime(
+                   last_timestamp, TIMESTAMP_FORMAT),
+               'log': log.encode('latin-1')}
+
+
+def _split_records(records):
+    """Split records into runs of at most about SEGMENT_BYTES of text."""
+
+    runs = []
+    size = 0
+    for record in records:
+        if not runs or size + len(record[3]) > SEGMENT_BYTES:
+            runs.append([])
+            size = 0
+        runs[-1].append(record)
+        size += len(record[3])
+    return runs
+
+
+def append_segment(cursor, work, entries, commit=True):
+    """Store (timestamp, log) pairs as the job's next segments.
+
+    Usually that is one segment, but long runs of entries, such as a whole
+    spool being replayed, are split into segments of at most SEGMENT_BYTES.
+    """
+
+    records = collapse(entries)
+    if not records:
+        return
+
+    cursor.execute('select max(segment) as segment, max(last_line) as line '
+                   'from work_log_segments where %s;' % _job_where(work))
+    row = cursor.fetchone()
+    segment = 0
+    first_line = 0
+    if row and row['segment'] is not None:
+        segment = row['segment'] + 1
+        first_line = row['line'] + 1
+
+    for run in _split_records(records):
+        lines = sum([record[1] for record in run])
+        cursor.execute('insert into work_log_segments(id, number, workname, '
+                       'constraints, attempt, segment, worker, first_line, '
+                       'last_line, records, first_timestamp, last_timestamp, '
+                       'data) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, '
+                       '%s, %s, %s, %s);',
+                       (work.ident, work.number, work.workname,
+                        work.constraints, work.attempt, segment, work.worker,
+                        first_line, first_line + lines - 1, len(run),
+                        run[0][0], run[-1][2], encode(run)))
+        segment += 1
+        first_line += lines
+    if commit:
+        cursor.execute('commit;')
+
+
+def read_records(cursor, work, first_line=None, last_line=None, since=None,
+                 until=None):
+    """Yield the records of a job's log, oldest first.
+
+    Each record is a dict of timestamp, log, count and last_timestamp, where
+    count is the number of identical lines it stands for. Only segments
+    overlapping the given line numbers or times are read. cursor should be
+    a streaming cursor for long logs, see utils.get_streaming_cursor.
+    """
+
+    conditions = [_job_where(work)]
+    if first_line is not None:
+        conditions.append('last_line >= %d' % first_line)
+    if last_line is not None:
+        conditions.append('first_line <= %d' % last_line)
+    if since is not None:
+        conditions.append('last_timestamp >= %s'
+                          % utils.datetime_as_sql(since))
+    if until is not None:
+        conditions.append('first_timestamp <= %s'
+                          % utils.datetime_as_sql(until))
+
+    cursor.execute('select first_line, data from work_log_segments where %s '
+                   'order by segment asc;' % ' and '.join(conditions))
+    found = False
+    for row in cursor:
+        found = True
+        line = row['first_line']
+        for record in decode(row['data']):
+            first = line
+            line += record['count']
+            if first_line is not None and line <= first_line:
+                continue
+            if last_line is not None and first > last_line:
+                continue
+            if since is not None and record['last_timestamp'] < since:
+                continue
+            if until is not None and record['timestamp'] > until:
+                continue
+            yield record
+    if found:
+        return
+
+    # Not converted from work_logs yet
+    cursor.execute('select * from work_logs where %s and worker="%s" '
+                   'order by timestamp asc;'
+                   %(_job_where(work), work.worker))
+    line = 0
+    for row in cursor:
+        line += 1
+        if first_line is not None and line - 1 < first_line:
+            continue
+        if last_line is not None and line - 1 > last_line:
+            continue
+        if since is not None and row['timestamp'] < since:
+            continue
+        if until is not None and row['timestamp'] > until:
+            continue
+        yield {'timestamp': row['timestamp'],
+               'count': 1,
+               'last_timestamp': row['timestamp'],
+               'log': row['log']}
+
+
+def clear(cursor, work):
+    cursor.execute('delete from work_log_segments where %s;'
+                   % _job_where(work))
+    cursor.execute('delete from work_logs where %s;' % _job_where(work))
+    cursor.execute('commit;')
+
+
+def migrate(limit=None):
+    """Convert jobs' work_logs rows into segments, a job at a time."""
+
+    # Imported here as workunit imports this module
+    import workunit
+
+    cursor = utils.get_cursor()
+    cursor.execute('select distinct id, number, workname, constraints, '
+                   'attempt, worker from work_logs%s;'
+                   %(' limit %d' % limit if limit else ''))
+    jobs = cursor.fetchall()
+
+    for job in jobs:
+        work = workunit.WorkUnit(job['id'], job['number'], job['workname'],
+                                 job['attempt'], job['constraints'])
+        work.worker = job['worker']
+
+        # The segments and the delete are one transaction, so an interrupted
+        # migration can simply be run again.
+        cursor.execute('delete from work_log_segments where %s;'
+                       % _job_where(work))
+        logcursor = utils.get_streaming_cursor()
+        logcursor.execute('select timestamp, log from work_logs where %s and '
+                          'worker="%s" order by timestamp asc;'
+                          %(_job_where(work), work.worker))
+        lines = 0
+        entries = []
+        for row in logcursor:
+            entries.append((row['timestamp'], row['log']))
+            if len(entries) >= MIGRATE_SEGMENT_LINES:
+                append_segment(cursor, work, entries, commit=False)
+                lines += len(entries)
+                entries = []
+        logcursor.close()
+        append_segment(cursor, work, entries, commit=False)
+        lines += len(entries)
+
+        cursor.execute('delete from work_logs where %s and worker="%s";'
+                       %(_job_where(work), work.worker))
+        cursor.execute('commit;')
+        print ('%s Converted %d lines for %s %s %s %s(%s)'
+               %(datetime.datetime.now(), lines, work.ident, work.number,
+                 work.workname, work.constraints, work.attempt))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] != 'migrate':
+        print 'Usage: %s migrate [<max jobs>]' % sys.argv[0]
+        sys.exit(1)
+
+    migrate(int(sys.argv[2]) if len(sys.argv) > 2 else None)
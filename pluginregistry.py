@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+"""Load plugins once and dispatch work to them."""
+
+# Plugins live in plugins/ and may declare what they handle:
+#
+#   WORK_PREFIXES: worknames starting with one of these are run by the
+#                  plugin's ExecuteWork(cursor, work, git_repo, change)
+#   FILE_PATTERNS: fnmatch patterns; the plugin's Handle(change, files) is
+#                  only called for patchsets changing a matching file
+#
+# Plugins which don't declare these are offered everything, as before.
+# A plugin is re-imported only when its source file changes.
+
+
+import datetime
+import fnmatch
+import imp
+import os
+import time
+
+
+class PluginRegistry(object):
+    def __init__(self, path='plugins'):
+        self.path = path
+        self.modules = {}
+        self.mtimes = {}
+        self.stats = {}
+
+        self.prefixes = {}
+        self.workname_cache = {}
+        self.refresh()
+
+    def refresh(self):
+        """Load new plugins and reload any whose source has changed."""
+
+        changed = False
+        seen = set()
+        for ent in os.listdir(self.path):
+            if ent[0] == '.' or not ent.endswith('.py'):
+                continue
+
+            name = ent[:-3]
+            seen.add(name)
+            mtime = os.stat(os.path.join(self.path, ent)).st_mtime
+            if self.mtimes.get(name) == mtime:
+                continue
+
+            plugin_info = imp.find_module(name, [self.path])
+            try:
+                self.modules[name] = imp.load_module(name, *plugin_info)
+            finally:
+                if plugin_info[0]:
+                    plugin_info[0].close()
+            self.mtimes[name] = mtime
+            self.stats.setdefault(name, {})
+            changed = True
+            print '%s Loaded plugin %s' %(datetime.datetime.now(), name)
+
+        for name in set(self.modules) - seen:
+            del self.modules[name]
+            del self.mtimes[name]
+            changed = True
+
+        if changed:
+            self.prefixes = {}
+            self.workname_cache = {}
+            for name, module in self.modules.items():
+                for prefix in getattr(module, 'WORK_PREFIXES', []):
+                    self.prefixes[prefix] = name
+
+    def _call(self, name, function, *args):
+        start = time.time()
+        try:
+            return getattr(self.modules[name], function)(*args)
+        finally:
+            stats = self.stats[name].setdefault(function,
+                                                {'calls': 0, 'seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += time.time() - start
+
+    def _plugin_for_workname(self, workname):
+        if workname in self.workname_cache:
+            return self.workname_cache[workname]
+
+        # Longest matching prefix wins. The answer is cached, so this scan
+        # only happens once per workname.
+        found = None
+        for prefix in sorted(self.prefixes, key=len, reverse=True):
+            if workname.startswith(prefix):
+                found = self.prefixes[prefix]
+                break
+        self.workname_cache[workname] = found
+        return found
+
+    def execute_work(self, cursor, work, git_repo, change):
+        """Run work with the plugin which handles it. Returns handled."""
+
+        name = self._plugin_for_workname(work.workname)
+        if name:
+            return self._call(name, 'ExecuteWork', cursor, work, git_repo,
+                              change)
+
+        for name, module in sorted(self.modules.items()):
+            if (hasattr(module, 'WORK_PREFIXES') or
+                not hasattr(module, 'ExecuteWork')):
+                continue
+            if self._call(name, 'ExecuteWork', cursor, work, git_repo,
+                          change):
+                return True
+        return False
+
+    def handle(self, change, files):
+        """Offer a patchset to every plugin interested in its files."""
+
+        for name, module in sorted(self.modules.items()):
+            if not hasattr(module, 'Handle'):
+                continue
+
+            patterns = getattr(module, 'FILE_PATTERNS', None)
+            if patterns is not None:
+                interested = False
+                for filename in files:
+                    for pattern in patterns:
+                        if fnmatch.fnmatch(filename, pattern):
+                            interested = True
+                            break
+                    if interested:
+                        break
+                if not interested:
+                    continue
+
+            self._call(name, 'Handle', change, files)
+
+    def report(self):
+        for name in sorted(self.stats):
+            for function, stats in sorted(self.stats[name].items()):
+                print ('%s Plugin %s.%s: %d calls, %.02f seconds'
+                       %(datetime.datetime.now(), name, function,
+                         stats['calls'], stats['seconds']))
+
+
+_registry = None
+
+
+def get_registry(path='plugins'):
+    global _registry
+    if _registry is None:
+        _registry = PluginRegistry(path)
+    else:
+        _registry.refresh()
+    return _registry
@@ -7,6 +7,10 @@ import workunit
 import utils
 
 
+WORK_PREFIXES = ['sqlalchemy_migration_']
+FILE_PATTERNS = ['nova/db/sqlalchemy/migrate_repo/versions/*']
+
+
 NEW_PATCH_EMAIL = """New database migration patchset discovered!
 
 %(subject)s by %(name)s
@@ -40,13 +44,14 @@ def Handle(change, files):
                             'files_list': '\n    '.join(files)})
 
         cursor = utils.get_cursor()
+        priority = workunit.priority_for_patchset(change['timestamp'])
         for dataset in ['nova_trivial_500', 'nova_trivial_6000',
                         'nova_user_001']:
             for constraint in ['mysql', 'percona']:
                 w = workunit.WorkUnit(change['id'], change['number'],
                                       'sqlalchemy_migration_%s' % dataset,
                                       0, constraint)
-                w.enqueue(cursor)
+                w.enqueue(cursor, priority=priority)
 
 
 MIGRATION_NAME_RE = re.compile('([0-9]+)_(.*)\.py')
@@ -80,16 +85,22 @@ def ExecuteWork(cursor, work, git_repo, change):
                 work.log(cursor, '%s: %s' %(migration, name))
             return True
 
-    safe_refurl = change['refurl'].replace('/', '_')
+    # Concurrent worker slots each get their own virtualenv, database and
+    # database user, so their runs can't collide.
+    suffix = work.slot_suffix()
+    safe_refurl = change['refurl'].replace('/', '_') + suffix
 
     flags = utils.get_config()
-    db = work.workname[len('sqlalchemy_migration_'):]
+    dataset = work.workname[len('sqlalchemy_migration_'):]
     cmd = ('/srv/openstack-ci-tools/plugins/test_sqlalchemy_migrations.sh '
-           '%(ref_url)s %(git_repo)s %(dbuser)s %(dbpassword)s %(db)s'
+           '%(ref_url)s %(git_repo)s %(dbuser)s %(dbpassword)s %(db)s '
+           '%(dataset)s %(engine)s'
            % {'ref_url': safe_refurl,
               'git_repo': git_repo,
-              'dbuser': flags['test_dbuser'],
+              'dbuser': flags['test_dbuser'] + suffix.replace('_slot', '_'),
               'dbpassword': flags['test_dbpassword'],
-              'db': db})
+              'db': dataset + suffix,
+              'dataset': dataset,
+              'engine': work.constraints})
     utils.execute(cursor, work, cmd, timeout=(3600 * 2))
     return True
@@ -5,15 +5,23 @@
 # $3 is the nova db user
 # $4 is the nova db password
 # $5 is the nova db name
+# $6 is the dataset to load, defaulting to $5. They differ when several
+#    worker slots run at once, as each slot gets its own database.
+# $7 is the database engine (mysql or percona), defaulting to mysql
 
 pip_requires() {
+  # $1 is the virtualenv name
   requires="tools/pip-requires"
   if [ ! -e $requires ]
   then
     requires="requirements.txt"
   fi
   echo "Install pip requirements from $requires"
-  pip install -q -r $requires
+
+  # Swap in a cached virtualenv built for exactly these requirements
+  deactivate 2> /dev/null || true
+  /usr/bin/python /srv/openstack-ci-tools/venvcache.py materialize $requires $1
+  source $WORKON_HOME/$1/bin/activate
   echo "Requirements installed"
 }
 
@@ -38,17 +46,23 @@ EOF
   then
     echo "***** DB upgrade to state of $1 starts *****"
     python $nova_manage --config-file $2/nova-$1.conf db sync
+    status=$?
   else
     python setup.py clean
     python setup.py develop
     echo "***** DB upgrade to state of $1 starts *****"
     nova-manage --config-file $2/nova-$1.conf db sync
+    status=$?
   fi
   echo "***** DB upgrade to state of $1 finished *****"
+  return $status
 }
 
 echo "To execute this script manually, run this:"
-echo "$0 $1 $2 $3 $4 $5"
+echo "$0 $1 $2 $3 $4 $5 $6 $7"
+
+dataset=${6:-$5}
+engine=${7:-mysql}
 
 set -x
 
@@ -56,54 +70,89 @@ set -x
 export PATH=/usr/lib/ccache:$PATH
 export PIP_DOWNLOAD_CACHE=/srv/cache/pip
 
-# Restore database to known good state
-echo "Restoring test database $5"
-mysql --defaults-file=/srv/config/mysql -u root -e "drop database $5"
-mysql --defaults-file=/srv/config/mysql -u root -e "create database $5"
-mysql --defaults-file=/srv/config/mysql -u root -e "create user '$3'@'localhost' identified by '$4';"
-mysql --defaults-file=/srv/config/mysql -u root -e "grant all privileges on $5.* TO '$3'@'localhost';"
-mysql -u $3 --password=$4 $5 < /srv/datasets/$5.sql
-
 echo "Build test environment"
 cd $2
 
+# Restore database to known good state. Unless the change alters an existing
+# migration, the state after upgrading to trunk only depends on the dataset,
+# the engine and the trunk commit, so it is cached. A cached state replaces
+# the database entirely, so it is tried before a full restore of the dataset.
+git checkout target
+alters_migrations=0
+if [ `git show | grep "^\-\-\-" | grep "migrate_repo/versions" | wc -l` -gt 0 ]
+then
+  alters_migrations=1
+fi
+trunk_commit=`git rev-parse trunk`
+trunk_cached=0
+if [ $alters_migrations -eq 0 ] && /usr/bin/python /srv/openstack-ci-tools/datasets.py restore-state $dataset $5 $engine $trunk_commit
+then
+  echo "Database restored to the state of trunk $trunk_commit from cache"
+  trunk_cached=1
+else
+  echo "Restoring test database $5 from dataset $dataset"
+  /usr/bin/python /srv/openstack-ci-tools/datasets.py restore $dataset $5 $engine
+fi
+mysql --defaults-file=/srv/config/mysql -u root -e "create user '$3'@'localhost' identified by '$4';"
+mysql --defaults-file=/srv/config/mysql -u root -e "grant all privileges on $5.* TO '$3'@'localhost';"
+
 set +x
 echo "Setting up virtual env"
 source ~/.bashrc
 source /etc/bash_completion.d/virtualenvwrapper
-rm -rf ~/virtualenvs/$1
-mkvirtualenv $1
-toggleglobalsitepackages
+export WORKON_HOME=${WORKON_HOME:-~/.virtualenvs}
 set -x
 export PYTHONPATH=$PYTHONPATH:$2
 
-# Some databases are from Folsom
-version=`mysql -u $3 --password=$4 $5 -e "select * from migrate_version \G" | grep version | sed 's/.*: //'`
-echo "Schema version is $version"
-if [ $version == "133" ]
-then
-  echo "Database is from Folsom! Upgrade via grizzly"
-  git checkout stable/grizzly
-  pip_requires
-  db_sync "grizzly" $2 $3 $4 $5
-fi
+upgrade_via_grizzly() {
+  # Some databases are from Folsom
+  version=`mysql -u $3 --password=$4 $5 -e "select * from migrate_version \G" | grep version | sed 's/.*: //'`
+  echo "Schema version is $version"
+  if [ $version == "133" ]
+  then
+    echo "Database is from Folsom! Upgrade via grizzly"
+    git checkout stable/grizzly
+    pip_requires $1
+    start=`date +%s`
+    db_sync "grizzly" $2 $3 $4 $5
+    status=$?
+    timings="$timings grizzly=$((`date +%s` - $start))"
+    return $status
+  fi
+}
 
 # Make sure the test DB is up to date with trunk
-git checkout target
-if [ `git show | grep "^\-\-\-" | grep "migrate_repo/versions" | wc -l` -gt 0 ]
+if [ $alters_migrations -eq 1 ]
 then
+  upgrade_via_grizzly $1 $2 $3 $4 $5
+  git checkout target
   echo "This change alters an existing migration, skipping trunk updates."
-else
+elif [ $trunk_cached -eq 0 ]
+then
+  timings=""
+  synced=1
+  upgrade_via_grizzly $1 $2 $3 $4 $5 || synced=0
+
   echo "Update database to current state of trunk"
   git checkout trunk
-  pip_requires
-  db_sync "trunk" $2 $3 $4 $5
+  pip_requires $1
+  start=`date +%s`
+  db_sync "trunk" $2 $3 $4 $5 || synced=0
+  timings="$timings trunk=$((`date +%s` - $start))"
+
+  # Only a successful upgrade is worth reusing
+  if [ $synced -eq 1 ]
+  then
+    /usr/bin/python /srv/openstack-ci-tools/datasets.py save-state $dataset $5 $engine $trunk_commit $timings
+  else
+    echo "Upgrade to trunk failed, not caching its state"
+  fi
   git checkout target
 fi
 
 # Now run the patchset
 echo "Now test the patchset"
-pip_requires
+pip_requires $1
 db_sync "patchset" $2 $3 $4 $5
 
 # Determine the final schema version
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+"""Summaries of job results for the dumper, fetched a page at a time."""
+
+# persist_to_disk records what it parsed out of each job's log in
+# work_results. Building a page of the index is then a handful of set based
+# queries over work_queue and work_results for just the patchsets on that
+# page, instead of several queries and a file read for every cell.
+#
+# Jobs dumped before work_results existed are loaded from their data files
+# with "results.py backfill".
+
+
+import datetime
+import json
+import os
+import sys
+
+import utils
+
+
+# Patchsets per query where a caller may pass any number
+KEYS_BATCH = 100
+
+
+def record(cursor, work, outcome, data):
+    cursor.execute('insert into work_results(id, number, workname, '
+                   'constraints, attempt, outcome, data) values (%s, %s, %s, '
+                   '%s, %s, %s, %s) on duplicate key update '
+                   'outcome=values(outcome), data=values(data);',
+                   (work.ident, work.number, work.workname, work.constraints,
+                    work.attempt, outcome, json.dumps(data)))
+    cursor.execute('commit;')
+
+
+def _keys_condition(keys, prefix=''):
+    """SQL and arguments matching any of a list of (id, number) keys.
+
+    Spelled out as ORs, as MySQL before 5.7 can't use an index for a row
+    constructor IN list.
+    """
+
+    sql = ('(%s)'
+           % ' or '.join(['(%(p)sid=%%s and %(p)snumber=%%s)'
+                          % {'p': prefix}] * len(keys)))
+    args = []
+    for ident, number in keys:
+        args.extend([ident, number])
+    return sql, args
+
+
+def patchsets(cursor, keys):
+    """Return {(id, number): patchsets row} for keys."""
+
+    found = {}
+    if not keys:
+        return found
+
+    sql, args = _keys_condition(keys)
+    cursor.execute('select * from patchsets where %s;' % sql, args)
+    for row in cursor:
+        found[(row['id'], row['number'])] = row
+    return found
+
+
+def latest_results(cursor, keys):
+    """Return the latest attempt at each test of each patchset in keys.
+
+    The result is {(id, number, workname): [row, ...]}, with a row for each
+    set of constraints in constraints order. Rows are work_queue rows, with
+    the job's parsed results in "data", or None if it hasn't been dumped.
+    """
+
+    found = {}
+    if not keys:
+        return found
+
+    # The latest attempt is found with a subquery on work_queue's primary
+    # key, and its results by work_results' primary key
+    sql, args = _keys_condition(keys, prefix='q.')
+    cursor.execute('select q.*, r.data as results from work_queue q '
+                   'left join work_results r '
+                   'using (id, number, workname, constraints, attempt) '
+                   'where %s and q.attempt=(select max(attempt) '
+                   'from work_queue l where l.id=q.id and '
+                   'l.number=q.number and l.workname=q.workname and '
+                   'l.constraints=q.constraints) '
+                   'order by q.constraints;' % sql, args)
+    for row in cursor:
+        row['data'] = json.loads(row['results']) if row['results'] else None
+        found.setdefault((row['id'], row['number'], row['workname']),
+                         []).append(row)
+    return found
+
+
+def job_months(cursor, keys):
+    """The months, as YYYY-MM, in which jobs of the patchsets in keys ran."""
+
+    months = set()
+    for i in range(0, len(keys), KEYS_BATCH):
+        sql, args = _keys_condition(keys[i:i + KEYS_BATCH])
+        cursor.execute('select distinct date_format(heartbeat, "%%Y-%%m") '
+                       'as month from work_queue where ' + sql + ' and '
+                       'heartbeat is not null;', args)
+        for row in cursor:
+            months.add(row['month'])
+    return months
+
+
+def results_for(cursor, ident, number):
+    """All finished attempts for a patchset, with their parsed results."""
+
+    cursor.execute('select q.*, r.data as results from work_queue q '
+                   'left join work_results r '
+                   'using (id, number, workname, constraints, attempt) '
+                   'where q.id=%s and q.number=%s and q.done is not null;',
+                   (ident, number))
+    rows = []
+    for row in cursor:
+        row['data'] = json.loads(row['results']) if row['results'] else None
+        rows.append(row)
+    return rows
+
+
+def summary(cursor):
+    """Counts shown at the top of the index, in one round trip."""
+
+    cursor.execute('select (select count(*) from patchsets) as total, '
+                   '(select count(*) from patchset_rechecks) as rechecks, '
+                   '(select max(timestamp) from patchsets) as recent, '
+                   '(select count(*) from work_queue where done="y") '
+                   'as jobs_done, '
+                   '(select count(*) from work_queue where done is null) '
+                   'as jobs_queued;')
+    return cursor.fetchone()
+
+
+def backfill():
+    """Load the data files of jobs dumped before work_results existed."""
+
+    # Imported here as workunit imports this module
+    import workunit
+
+    cursor = utils.get_cursor()
+    subcursor = utils.get_cursor()
+    cursor.execute('select q.* from work_queue q left join work_results r '
+                   'using (id, number, workname, constraints, attempt) '
+                   'where q.dumped="y" and r.id is null;')
+    loaded = 0
+    for row in cursor:
+        work = workunit.WorkUnit(row['id'], row['number'], row['workname'],
+                                 row['attempt'], row['constraints'])
+        datapath = os.path.join(work.disk_path(), 'data')
+        if not os.path.exists(datapath):
+            continue
+        with open(datapath) as f:
+            data = json.loads(f.read())
+        record(subcursor, work, row['outcome'], data)
+        loaded += 1
+    print '%s Loaded %d results' %(datetime.datetime.now(), loaded)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] != 'backfill':
+        print 'Usage: %s backfill' % sys.argv[0]
+        sys.exit(1)
+
+    backfill()
@@ -0,0 +1,11 @@
+-- Priority ordered queue claims for workunit.dequeue_work.
+--
+-- Higher priority work is claimed first. Rechecks and fresh patchsets are
+-- queued above backfill, see the PRIORITY_* constants in workunit.py. The
+-- index covers the pending set a worker scans when it claims work.
+
+alter table work_queue
+  add column priority int not null default 0;
+
+alter table work_queue
+  add index pending_idx (constraints, selectid, priority);
@@ -0,0 +1,10 @@
+-- Byte offsets into each stream logger's day files which eventparser has
+-- already ingested, so later runs only fetch new bytes.
+
+create table ingest_checkpoints (
+  host varchar(32) not null,
+  day date not null,
+  offset bigint not null default 0,
+  updated datetime,
+  primary key (host, day)
+) engine=InnoDB;
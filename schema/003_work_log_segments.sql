@@ -0,0 +1,20 @@
+-- Job logs stored as compressed, run length collapsed segments, replacing a
+-- work_logs row per line. See logstore.py. Existing work_logs rows are
+-- converted with "logstore.py migrate".
+
+create table work_log_segments (
+  id varchar(64) not null,
+  number int not null,
+  workname varchar(128) not null,
+  constraints varchar(32) not null,
+  attempt int not null,
+  segment int not null,
+  worker varchar(255),
+  first_line int not null,
+  last_line int not null,
+  records int not null,
+  first_timestamp datetime not null,
+  last_timestamp datetime not null,
+  data mediumblob not null,
+  primary key (id, number, workname, constraints, attempt, segment)
+) engine=InnoDB;
@@ -0,0 +1,19 @@
+-- What persist_to_disk parsed out of each job's log, so the dumper can build
+-- a page with a few set based queries instead of reading a data file per
+-- job. See results.py. Jobs dumped earlier are loaded with
+-- "results.py backfill".
+
+create table work_results (
+  id varchar(64) not null,
+  number int not null,
+  workname varchar(128) not null,
+  constraints varchar(32) not null,
+  attempt int not null,
+  outcome varchar(16),
+  data mediumtext not null,
+  primary key (id, number, workname, constraints, attempt)
+) engine=InnoDB;
+
+-- The index pages list the most recently run jobs
+alter table work_queue
+  add index heartbeat_idx (heartbeat);
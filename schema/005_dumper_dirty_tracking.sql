@@ -0,0 +1,23 @@
+-- Lets the dumper regenerate only the pages affected by changes since its
+-- last run. work_queue.changed is set when a row is queued and when it
+-- finishes or is dumped (see workunit.py), but not by heartbeats or claims.
+-- The database stamps new patchset_files rows, and dumper_state holds the
+-- time of the last dump.
+-- The dumped and emailed indexes keep the scans for pending work cheap when
+-- there is none.
+
+alter table work_queue
+  add column changed timestamp not null default current_timestamp,
+  add index changed_idx (changed),
+  add index dumped_idx (dumped),
+  add index emailed_idx (emailed);
+
+alter table patchset_files
+  add column added timestamp not null default current_timestamp,
+  add index added_idx (added);
+
+create table dumper_state (
+  name varchar(32) not null,
+  value datetime,
+  primary key (name)
+) engine=InnoDB;
@@ -0,0 +1,8 @@
+-- Lets several dumpers render finished jobs at once. A dumper claims a batch
+-- of pending jobs by stamping them with its claim id, and a claim older than
+-- dumper.RENDER_CLAIM_SECONDS is taken over by the next dumper to look.
+
+alter table work_queue
+  add column dump_claim varchar(80) default NULL,
+  add column dump_claimed datetime default NULL,
+  add index dump_claim_idx (dump_claim);
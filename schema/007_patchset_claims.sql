@@ -0,0 +1,6 @@
+-- eventparser and eventstream claim patchsets before fetching or handling
+-- them, by moving them to the "g" or "h" state. claimed records when, so a
+-- claim left by a process which died can be taken over. See eventparser.py.
+
+alter table patchsets
+  add column claimed datetime default NULL;
@@ -0,0 +1,186 @@
+#!/usr/bin/python
+
+"""Files published to the web server, precompressed and only when changed."""
+
+# Everything the dumper writes under /var/www/ci goes through StaticFile. As
+# well as replacing the file atomically, it:
+#
+#  - writes a gzip copy alongside it, and a brotli one if the brotli module
+#    is installed, so the web server can send those as they are
+#    (gzip_static and brotli_static in nginx) instead of compressing the
+#    same multi-megabyte log on every request
+#  - records a hash of the content as the file's ETag in the directory's
+#    etags.json, and leaves the file and its copies alone when the content
+#    is unchanged, so their mtimes and the web server's cache validators
+#    stay the same
+#
+# etags.json is updated under a lock on the directory, so render processes
+# and concurrent dumpers can publish into the same directory.
+
+
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+
+import utils
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MANIFEST_NAME = 'etags.json'
+LOCK_NAME = '.etags.lock'
+COPY_SIZE = 1024 * 1024
+# Pages are compressed by the render processes, so the levels trade a
+# little size for speed rather than using each format's slow maximum
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Compressed copies of files smaller than this save too little to bother
+COMPRESS_MIN_BYTES = 256
+
+ENCODINGS = ['gzip']
+if brotli:
+    ENCODINGS.append('br')
+EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
+
+
+class _HashingWriter(object):
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.f.write(data)
+
+
+class _DirectoryLock(object):
+    def __init__(self, path):
+        self.path = os.path.join(path, LOCK_NAME)
+
+    def __enter__(self):
+        self.f = open(self.path, 'a')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+        return False
+
+
+def read_manifest(path):
+    """Return {filename: {etag, size, encodings}} for a directory."""
+
+    try:
+        with open(os.path.join(path, MANIFEST_NAME)) as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_manifest(path, manifest):
+    with utils.AtomicFile(os.path.join(path, MANIFEST_NAME)) as f:
+        f.write(json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def _compress(source, path, encoding):
+    tmp = '%s.%d.tmp' %(path, os.getpid())
+    with open(source) as src:
+        with open(tmp, 'w') as out:
+            if encoding == 'gzip':
+                # A fixed mtime keeps the output the same for the same input
+                z = gzip.GzipFile(filename='', mode='wb', fileobj=out,
+                                  compresslevel=GZIP_LEVEL, mtime=0)
+                while True:
+                    d = src.read(COPY_SIZE)
+                    if not d:
+                        break
+                    z.write(d)
+                z.close()
+            else:
+                c = brotli.Compressor(quality=BROTLI_QUALITY)
+                while True:
+                    d = src.read(COPY_SIZE)
+                    if not d:
+                        break
+                    out.write(c.process(d))
+                out.write(c.finish())
+    os.rename(tmp, path)
+
+
+def _unlink(path):
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+class StaticFile(object):
+    """Publish a file, see the top of this module.
+
+    Used like utils.AtomicFile. Afterwards, changed says whether the file
+    was written or its content was already there.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = '%s.%d.tmp' %(path, os.getpid())
+        self.changed = False
+
+    def __enter__(self):
+        self.f = open(self.tmp, 'w')
+        self.writer = _HashingWriter(self.f)
+        return self.writer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+        if exc_type:
+            os.unlink(self.tmp)
+            return False
+
+        directory, name = os.path.split(self.path)
+        encodings = []
+        if self.writer.size >= COMPRESS_MIN_BYTES:
+            encodings = ENCODINGS
+        entry = {'etag': self.writer.hash.hexdigest(),
+                 'size': self.writer.size,
+                 'encodings': encodings}
+
+        try:
+            with _DirectoryLock(directory):
+                manifest = read_manifest(directory)
+                if manifest.get(name) == entry and os.path.exists(self.path):
+                    return False
+
+                # The copies go first, so a copy is never older than the file
+                for encoding in EXTENSIONS:
+                    copy = self.path + EXTENSIONS[encoding]
+                    if encoding in encodings:
+                        _compress(self.tmp, copy, encoding)
+                    else:
+                        _unlink(copy)
+                os.rename(self.tmp, self.path)
+                self.changed = True
+
+                manifest[name] = entry
+                _write_manifest(directory, manifest)
+        finally:
+            _unlink(self.tmp)
+        return False
+
+
+def remove(path):
+    """Remove a published file and its compressed copies."""
+
+    directory, name = os.path.split(path)
+    with _DirectoryLock(directory):
+        for extension in [''] + EXTENSIONS.values():
+            _unlink(path + extension)
+        manifest = read_manifest(directory)
+        if name in manifest:
+            del manifest[name]
+            _write_manifest(directory, manifest)
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+
+"""Checks for the dumper's rendering stage, run with python -m unittest."""
+
+import unittest
+
+import dumper
+import utils
+import workunit
+
+
+class FakeCursor(object):
+    """Just enough of work_queue for claim_pending."""
+
+    def __init__(self, rows):
+        self.pending = rows
+        self.claimed = []
+        self.result = []
+        self.rowcount = 0
+
+    def execute(self, sql, args=None):
+        self.result = []
+        if sql.startswith('update work_queue set dump_claim'):
+            self.claimed = self.pending
+            self.pending = []
+            self.rowcount = len(self.claimed)
+        elif sql.startswith('select * from work_queue where dump_claim'):
+            self.result = self.claimed
+            self.rowcount = len(self.result)
+        else:
+            # Like MySQL, a commit affects no rows
+            self.rowcount = 0
+
+    def fetchall(self):
+        return self.result
+
+
+class RenderPendingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rendered = []
+        self.dumped = []
+        self.saved = (dumper.__dict__.get('cursor'), utils.get_cursor,
+                      workunit.WorkUnit.persist_to_disk,
+                      workunit.WorkUnit.mark_dumped)
+
+        test = self
+        def persist_to_disk(work, cursor):
+            test.rendered.append(work.ident)
+        def mark_dumped(work, cursor):
+            test.dumped.append(work.ident)
+
+        utils.get_cursor = lambda: None
+        workunit.WorkUnit.persist_to_disk = persist_to_disk
+        workunit.WorkUnit.mark_dumped = mark_dumped
+
+    def tearDown(self):
+        (dumper.cursor, utils.get_cursor, workunit.WorkUnit.persist_to_disk,
+         workunit.WorkUnit.mark_dumped) = self.saved
+
+    def test_pending_row_is_rendered(self):
+        dumper.cursor = FakeCursor([{'id': 'I1', 'number': 1,
+                                     'workname': 'sqlalchemy_migration_nova',
+                                     'attempt': 0, 'constraints': 'mysql',
+                                     'worker': 'worker1'}])
+        dumper.render_pending(1)
+        self.assertEqual(['I1'], self.rendered)
+        self.assertEqual(['I1'], self.dumped)
+
+
+if __name__ == '__main__':
+    unittest.main()
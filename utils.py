@@ -1,7 +1,10 @@
 #!/usr/bin/python
 
 import datetime
+import dbpool
 import git
+import gitcheckouts
+import inotify
 import json
 import mimetypes
 import MySQLdb
@@ -20,22 +23,42 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 
+CONFIG_PATH = '/srv/config/gerritevents'
+_config = None
+_config_mtime = None
+
+
 def get_config():
-    # Read config from a file
-    with open('/srv/config/gerritevents') as f:
-        config = f.read().replace('\n', '')
-        return json.loads(config)
+    # Read config from a file, but only when it has changed on disk
+    global _config
+    global _config_mtime
+
+    mtime = os.stat(CONFIG_PATH).st_mtime
+    if _config is None or mtime != _config_mtime:
+        with open(CONFIG_PATH) as f:
+            config = f.read().replace('\n', '')
+            _config = json.loads(config)
+            _config_mtime = mtime
+    return dict(_config)
 
 
 def get_cursor():
-    """Get a database cursor."""
-    flags = get_config()
-    db = MySQLdb.connect(user = flags['dbuser'],
-                         db = flags['dbname'],
-                         passwd = flags['dbpassword'],
-                         host = flags['dbhost'])
-    cursor = db.cursor(MySQLdb.cursors.DictCursor)
-    return cursor
+    """Get a database cursor backed by the shared connection pool."""
+    return dbpool.PooledCursor(dbpool.get_pool(get_config()))
+
+
+def get_streaming_cursor():
+    """Get a cursor which leaves results on the server until they are read.
+
+    Use this for result sets too big to hold in memory. The rows must all be
+    read, or the cursor closed, before the connection can be used again.
+    """
+    return dbpool.PooledCursor(dbpool.get_pool(get_config()),
+                               cursorclass=MySQLdb.cursors.SSDictCursor)
+
+
+def get_pool_stats():
+    return dbpool.get_pool(get_config()).stats()
 
 
 def format_attempt_path(attempt):
@@ -47,8 +70,7 @@ def format_attempt_path(attempt):
 def send_email(subject, mailto, body):
     """Send an email."""
 
-    with open('/srv/config/gerritevents') as f:
-        flags = json.loads(f.read())
+    flags = get_config()
 
     msg = MIMEMultipart()
     msg['Subject'] = subject
@@ -75,8 +97,8 @@ def get_patchset_details(cursor, work):
     return cursor.fetchone()
 
 
-def _calculate_directories(project, refurl):
-    safe_refurl = refurl.replace('/', '_')
+def _calculate_directories(project, refurl, suffix=''):
+    safe_refurl = refurl.replace('/', '_') + suffix
     git_dir = os.path.join(GIT_DIR, project)
     cow_dir = os.path.join(COW_DIR, project + '_' + safe_refurl)
     visible_dir = os.path.join(VISIBLE_DIR, project + '_' + safe_refurl)
@@ -96,94 +118,172 @@ def clone_git(project):
         l = p.stdout.readline()
 
 
-def create_git(project, refurl, cursor, work, rewind):
-    """Get a safe COW git checkout of the named refurl."""
+def create_git(project, refurl, cursor, work, max_rewind=10):
+    """Get a git checkout of the named refurl, sharing the mirror's objects."""
 
-    conflict = False
-    git_dir, cow_dir, visible_dir = _calculate_directories(project, refurl)
-    cmd = ('/srv/openstack-ci-tools/gitcheckout.sh "%(visible_dir)s" '
-           '"%(project)s" "%(refurl)s" %(rewind)s 2>&1'
-           %{'cow_dir': cow_dir,
-             'git_dir': git_dir,
-             'visible_dir': visible_dir,
-             'project': project,
-             'refurl': refurl,
-             'rewind': rewind})
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    l = p.stdout.readline()
-    while l:
-        work.log(cursor, l)
-        if l.find('CONFLICT') != -1:
-            conflict = True
-        l = p.stdout.readline()
+    git_dir, cow_dir, visible_dir = _calculate_directories(
+        project, refurl, suffix=work.slot_suffix())
+    conflict = gitcheckouts.create_checkout(
+        project, refurl, visible_dir, lambda l: work.log(cursor, l),
+        max_rewind=max_rewind,
+        interval=get_config().get('git_refresh_interval',
+                                  gitcheckouts.DEFAULT_REFRESH_INTERVAL))
     return visible_dir, conflict
 
 
+class AtomicFile(object):
+    """A file written under a temporary name and renamed into place.
+
+    Readers such as the web server see either the old file or the new one,
+    never a partly written one. Nothing is replaced if the block raises.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = '%s.%d.tmp' %(path, os.getpid())
+
+    def __enter__(self):
+        self.f = open(self.tmp, 'w')
+        return self.f
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+        if exc_type:
+            os.unlink(self.tmp)
+            return False
+        os.rename(self.tmp, self.path)
+
+
 def datetime_as_sql(value):
     return ('STR_TO_DATE("%s", "%s")'
             %(value.strftime('%a, %d %b %Y %H:%M:%S'),
               '''%a, %d %b %Y %H:%i:%s'''))
 
 
+# Log files tailed into the job log while a command runs, with their prefixes
+TAILED_LOGS = [('/var/log/syslog', '[syslog] '),
+               ('/var/log/mysql/slow-queries.log', '[sqlslo] '),
+               ('/var/log/mysql/error.log', '[sqlerr] ')]
+HEARTBEAT_INTERVAL = 30
+# Only used if inotify is unavailable and the tailed files must be polled
+TAIL_POLL_INTERVAL = 1.0
+READ_SIZE = 1024 * 1024
+
+
 def execute(cursor, work, cmd, timeout=-1):
-    names = {}
-    lines = {}
-    syslog = os.open('/var/log/syslog', os.O_RDONLY)
-    os.lseek(syslog, 0, os.SEEK_END)
-    names[syslog] = '[syslog] '
-    lines[syslog] = ''
+    """Run cmd, logging its output and the tailed system logs as it runs.
 
-    slow = os.open('/var/log/mysql/slow-queries.log', os.O_RDONLY)
-    os.lseek(slow, 0, os.SEEK_END)
-    names[slow] = '[sqlslo] '
-    lines[slow] = ''
+    The loop blocks in epoll until the child writes something, a tailed log
+    grows (via inotify), or a heartbeat or timeout is due, so the harness
+    itself uses next to no CPU while a test runs.
+    """
 
-    mysql = os.open('/var/log/mysql/error.log', os.O_RDONLY)
-    os.lseek(mysql, 0, os.SEEK_END)
-    names[mysql] = '[sqlerr] '
-    lines[mysql] = ''
+    names = {}
+    lines = {}
+    tailed = {}
+    for path, name in TAILED_LOGS:
+        fd = os.open(path, os.O_RDONLY)
+        os.lseek(fd, 0, os.SEEK_END)
+        names[fd] = name
+        lines[fd] = ''
+        tailed[path] = fd
 
     cmd += ' 2>&1'
     start_time = time.time()
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-    names[p.stdout.fileno()] = ''
-    lines[p.stdout.fileno()] = ''
-
-    poll_obj = select.poll()
-    poll_obj.register(p.stdout, select.POLLIN | select.POLLHUP)
-    poll_obj.register(syslog, select.POLLIN)
-    poll_obj.register(slow, select.POLLIN)
-    poll_obj.register(mysql, select.POLLIN)
+    # The child gets its own process group so a timeout kills the whole
+    # pipeline rather than just the shell, which would leave the pipe open.
+    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                         preexec_fn=os.setsid)
+    out = p.stdout.fileno()
+    names[out] = ''
+    lines[out] = ''
+
+    epoll = select.epoll()
+    epoll.register(out, select.EPOLLIN | select.EPOLLHUP)
+
+    watches = {}
+    notifier = None
+    try:
+        notifier = inotify.Inotify()
+        for path, fd in tailed.items():
+            watches[notifier.add_watch(path)] = fd
+        epoll.register(notifier.fileno(), select.EPOLLIN)
+    except OSError, e:
+        print 'inotify unavailable, polling log files instead: %s' % e
+        if notifier:
+            notifier.close()
+        notifier = None
+        watches = {}
+
+    state = {'last_output': time.time()}
 
-    last_heartbeat = time.time()
     def process(fd):
-        lines[fd] += os.read(fd, 1024 * 1024)
+        data = os.read(fd, READ_SIZE)
+        if not data:
+            return False
+
+        lines[fd] += data
         if lines[fd].find('\n') != -1:
             elems = lines[fd].split('\n')
             for l in elems[:-1]:
                 l = '%s%s' %(names[fd], l)
                 work.log(cursor, l)
             lines[fd] = elems[-1]
-            last_heartbeat = time.time()
-
-    phase = 0
-    while phase < 2:
-        if timeout > 0 and time.time() - start_time > timeout:
-            work.log(cursor, '[timeout]')
-            os.kill(p.pid, 9)
-
-        for fd, flag in poll_obj.poll(0):
-            process(fd)
-
-        if time.time() - last_heartbeat > 30:
-            work.log(cursor, '[heartbeat]')
-            last_heartbeat = time.time()
-
-        if p.poll() is not None:
-            phase += 1
-            print 'Phase advanced to %s' % phase
-
-    process(p.stdout.fileno())
+            state['last_output'] = time.time()
+        return True
+
+    def drain(fd):
+        while process(fd):
+            pass
+
+    killed = False
+    child_open = True
+    try:
+        while child_open:
+            now = time.time()
+            deadlines = [state['last_output'] + HEARTBEAT_INTERVAL]
+            if timeout > 0 and not killed:
+                deadlines.append(start_time + timeout)
+            if not notifier:
+                deadlines.append(now + TAIL_POLL_INTERVAL)
+
+            for fd, _ in epoll.poll(max(0, min(deadlines) - now)):
+                if fd == out:
+                    child_open = process(out)
+                elif notifier and fd == notifier.fileno():
+                    for wd, _ in notifier.read_events():
+                        if wd in watches:
+                            drain(watches[wd])
+
+            if not notifier:
+                for fd in tailed.values():
+                    drain(fd)
+
+            now = time.time()
+            if timeout > 0 and not killed and now - start_time > timeout:
+                work.log(cursor, '[timeout]')
+                os.killpg(p.pid, 9)
+                killed = True
+
+            if work.lease_lost and not killed:
+                work.log(cursor, '[lease lost]')
+                os.killpg(p.pid, 9)
+                killed = True
+
+            if now - state['last_output'] > HEARTBEAT_INTERVAL:
+                work.log(cursor, '[heartbeat]')
+                state['last_output'] = now
+
+        p.wait()
+        for fd in tailed.values():
+            drain(fd)
+
+    finally:
+        epoll.close()
+        if notifier:
+            notifier.close()
+        for fd in tailed.values():
+            os.close(fd)
 
     for fd in lines:
         if lines[fd]:
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+"""A content addressed cache of virtualenvs, keyed on requirements."""
+
+# Almost every patchset has the same requirements, so building a fresh
+# virtualenv and pip installing into it for every job is wasted time.
+# Instead virtualenvs are built once per (requirements, python version) into
+# /srv/cache/venvs/<key> and copied into place for each job. Packages are
+# built into a local wheelhouse, so a cache miss can usually install without
+# touching the network. Least recently used entries are evicted once the
+# cache exceeds its disk budget (the venv_cache_bytes config key).
+#
+# Usage: venvcache.py materialize <requirements file> <virtualenv name>
+
+
+import datetime
+import fcntl
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import utils
+
+
+CACHE_DIR = '/srv/cache/venvs'
+WHEELHOUSE = '/srv/cache/wheelhouse'
+DEFAULT_BUDGET = 20 * 1024 * 1024 * 1024
+LAST_USED = '.last_used'
+
+
+def log(msg):
+    print '%s %s' %(datetime.datetime.now(), msg)
+    sys.stdout.flush()
+
+
+def workon_home():
+    return os.environ.get('WORKON_HOME',
+                          os.path.expanduser('~/.virtualenvs'))
+
+
+def cache_key(requirements):
+    h = hashlib.sha1()
+    h.update(sys.version)
+    with open(requirements) as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+class _Lock(object):
+    def __init__(self, path, flags=fcntl.LOCK_EX):
+        self.path = path
+        self.flags = flags
+
+    def __enter__(self):
+        self.f = open(self.path, 'w')
+        fcntl.flock(self.f, self.flags)
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+
+def _pip(venv, *args):
+    return subprocess.call([os.path.join(venv, 'bin', 'pip')] + list(args))
+
+
+def build(key, requirements):
+    path = os.path.join(CACHE_DIR, key)
+    tmp = path + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+
+    log('Virtualenv cache miss, building %s' % key)
+    subprocess.check_call(['virtualenv', '--system-site-packages', tmp])
+
+    # Fill the wheelhouse, then install from it alone. If either step
+    # fails, fall back to a normal networked install.
+    if not os.path.exists(WHEELHOUSE):
+        os.makedirs(WHEELHOUSE)
+    if (_pip(tmp, 'wheel', '-q', '--find-links', WHEELHOUSE,
+             '--wheel-dir', WHEELHOUSE, '-r', requirements) != 0 or
+        _pip(tmp, 'install', '-q', '--no-index', '--find-links', WHEELHOUSE,
+             '-r', requirements) != 0):
+        log('Offline install failed, installing from the network')
+        if _pip(tmp, 'install', '-q', '-r', requirements) != 0:
+            shutil.rmtree(tmp)
+            raise Exception('pip install -r %s failed' % requirements)
+
+    shutil.copyfile(requirements, os.path.join(tmp, '.requirements'))
+    os.rename(tmp, path)
+    return path
+
+
+def _rewrite_paths(venv, old, new):
+    """Point the scripts of a copied virtualenv at their new location."""
+
+    bindir = os.path.join(venv, 'bin')
+    for ent in os.listdir(bindir):
+        path = os.path.join(bindir, ent)
+        if os.path.islink(path) or not os.path.isfile(path):
+            continue
+        with open(path) as f:
+            content = f.read()
+        if '\0' in content or old not in content:
+            continue
+        with open(path, 'w') as f:
+            f.write(content.replace(old, new))
+
+
+def _size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def evict(budget, keep):
+    entries = []
+    total = 0
+    for ent in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, ent)
+        if ent == keep or not os.path.isdir(path) or ent.endswith('.tmp'):
+            continue
+        try:
+            last_used = os.stat(os.path.join(path, LAST_USED)).st_mtime
+        except OSError:
+            last_used = 0
+        size = _size(path)
+        entries.append((last_used, ent, path, size))
+        total += size
+    total += _size(os.path.join(CACHE_DIR, keep))
+
+    entries.sort()
+    while total > budget and entries:
+        _, ent, path, size = entries.pop(0)
+        lock = os.path.join(CACHE_DIR, ent + '.lock')
+        try:
+            with _Lock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                shutil.rmtree(path)
+        except IOError:
+            # In use by another job right now
+            continue
+        total -= size
+        log('Evicted virtualenv %s (%d bytes)' %(ent, size))
+
+
+def materialize(requirements, name):
+    """Make virtualenv name a copy of the cached env for requirements."""
+
+    start = time.time()
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+
+    key = cache_key(requirements)
+    path = os.path.join(CACHE_DIR, key)
+    dest = os.path.join(workon_home(), name)
+
+    with _Lock(path + '.lock'):
+        hit = os.path.exists(path)
+        if not hit:
+            build(key, requirements)
+
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        # Reflinks make this copy on write where the filesystem allows it
+        subprocess.check_call(['cp', '-a', '--reflink=auto', path, dest])
+        _rewrite_paths(dest, path, dest)
+        with open(os.path.join(path, LAST_USED), 'w') as f:
+            f.write('%s\n' % name)
+
+    log('Virtualenv %s from cache %s (%s) in %.02f seconds'
+        %(name, key, 'hit' if hit else 'miss', time.time() - start))
+
+    evict(utils.get_config().get('venv_cache_bytes', DEFAULT_BUDGET), key)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4 or sys.argv[1] != 'materialize':
+        print ('Usage: %s materialize <requirements file> <virtualenv name>'
+               % sys.argv[0])
+        sys.exit(1)
+
+    materialize(sys.argv[2], sys.argv[3])
@@ -1,64 +1,166 @@
 #!/usr/bin/python
 
 # Pull work entries off the queue and execute them
+#
+# By default a single worker runs in this process. If the config sets
+# worker_slots (or --slots is passed), this process instead supervises that
+# many worker subprocesses. Each slot gets its own test database, database
+# user, git checkout and virtualenv, and is pinned to its own share of the
+# CPUs so that concurrent runs don't skew each other's timings too much.
 
-import imp
+import argparse
+import datetime
+import multiprocessing
 import os
 import socket
+import subprocess
+import sys
+import time
 
+import heartbeat
+import pluginregistry
 import workunit
 import utils
 
 
-if __name__ == '__main__':
+# A slot which crashes is restarted, but not forever
+MAX_SLOT_RESTARTS = 5
+
+# How often a worker looks for stalled work units to requeue
+REAP_INTERVAL = 60
+
+
+def worker_name(slot):
+    hostname = socket.gethostname()
+    if slot is None:
+        return hostname
+    return '%s-slot%d' % (hostname, slot)
+
+
+def slot_cpus(slot, slots):
+    """Return the CPUs a slot is pinned to, as a taskset list."""
+
+    cpus = multiprocessing.cpu_count()
+    per_slot = cpus / slots
+    if per_slot < 1:
+        return None
+    first = slot * per_slot
+    return '%d-%d' % (first, first + per_slot - 1)
+
+
+def run_work(cursor, plugins, work, slot):
+    print '=========================================================='
+    work.clear_log(cursor)
+    work.start_log_shipper()
+    if slot is not None:
+        work.log(cursor, 'Running in worker slot %d' % slot)
+
+    # Checkout the patchset
+    change = utils.get_patchset_details(cursor, work)
+    git_repo, conflict = utils.create_git(change['project'],
+                                          change['refurl'],
+                                          cursor, work)
+    if conflict:
+        work.log(cursor, 'Git merge failure detected')
+        work.set_conflict(cursor)
+        return
+
+    work.log(cursor, 'Git checkout created')
+
+    handled = plugins.execute_work(cursor, work, git_repo, change)
+    if handled:
+        work.set_done(cursor)
+
+    if not handled:
+        work.log(cursor,
+                 'No plugin found for work of %s type'
+                 % work.workname)
+        work.set_missing(cursor)
+
+
+def run_worker(slot=None):
     cursor = utils.get_cursor()
-    worker = socket.gethostname()
+    worker = worker_name(slot)
     constraints = utils.get_config().get('constraints', '')
+    workunit.replay_log_spools(cursor, worker)
+    plugins = pluginregistry.get_registry()
+    last_reap = 0
 
     try:
         while True:
+            if time.time() - last_reap > REAP_INTERVAL:
+                workunit.reap_expired_leases(cursor,
+                                             heartbeat.lease_seconds())
+                last_reap = time.time()
+
             work = workunit.dequeue_work(cursor, worker, constraints)
-            print '=========================================================='
-            work.clear_log(cursor)
-
-            # Checkout the patchset
-            change = utils.get_patchset_details(cursor, work)
-            conflict = True
-            rewind = 0
-
-            while conflict and rewind < 10:
-                git_repo, conflict = utils.create_git(change['project'],
-                                                      change['refurl'],
-                                                      cursor, work, rewind)
-                if conflict:
-                    work.log(cursor, 'Git merge failure with HEAD~%d' % rewind)
-                    rewind += 1
-
-            if conflict:
-                work.log(cursor, 'Git merge failure detected')
-                work.set_conflict(cursor)
-                continue
+            plugins.refresh()
+            work.slot = slot
+            work.start_heartbeat()
+            try:
+                run_work(cursor, plugins, work, slot)
+            except workunit.LeaseLost:
+                print ('%s Abandoned %s %s %s %s(%s), its lease expired'
+                       %(datetime.datetime.now(), work.ident, work.number,
+                         work.workname, work.constraints, work.attempt))
+
+    except workunit.NoWorkFound:
+        pass
 
-            work.log(cursor, 'Git checkout created')
+    plugins.report()
 
-            # Load plugins
-            plugins = []
-            for ent in os.listdir('plugins'):
-                if ent[0] != '.' and ent.endswith('.py'):
-                    plugin_info = imp.find_module(ent[:-3], ['plugins'])
-                    plugins.append(imp.load_module(ent[:-3], *plugin_info))
 
-            handled = False
-            for plugin in plugins:
-                handled = plugin.ExecuteWork(cursor, work, git_repo, change)
-                if handled:
-                    work.set_done(cursor)
-                    break
+def start_slot(slot, slots):
+    cmd = [sys.executable, os.path.abspath(__file__), '--slot', str(slot)]
+    cpus = slot_cpus(slot, slots)
+    if cpus:
+        cmd = ['taskset', '-c', cpus] + cmd
+    print '%s Starting slot %d: %s' %(datetime.datetime.now(), slot,
+                                      ' '.join(cmd))
+    return subprocess.Popen(cmd)
 
-            if not handled:
-                work.log(cursor,
-                         'No plugin found for work of %s type' % workname)
-                work.set_missing(cursor)
 
-    except workunit.NoWorkFound:
-        pass
+def supervise(slots):
+    """Run a worker per slot, restarting any which crash."""
+
+    running = {}
+    restarts = {}
+    for slot in range(slots):
+        running[slot] = start_slot(slot, slots)
+        restarts[slot] = 0
+
+    while running:
+        time.sleep(5)
+        for slot, p in running.items():
+            if p.poll() is None:
+                continue
+
+            del running[slot]
+            if p.returncode == 0:
+                print ('%s Slot %d finished, queue is empty'
+                       %(datetime.datetime.now(), slot))
+            elif restarts[slot] < MAX_SLOT_RESTARTS:
+                restarts[slot] += 1
+                print ('%s Slot %d exited with %d, restarting'
+                       %(datetime.datetime.now(), slot, p.returncode))
+                running[slot] = start_slot(slot, slots)
+            else:
+                print ('%s Slot %d exited with %d too many times, giving up'
+                       %(datetime.datetime.now(), slot, p.returncode))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slots', type=int,
+                        default=utils.get_config().get('worker_slots', 1),
+                        help='number of work units to run concurrently')
+    parser.add_argument('--slot', type=int, default=None,
+                        help='run as the worker for this slot')
+    args = parser.parse_args()
+
+    if args.slot is not None:
+        run_worker(args.slot)
+    elif args.slots > 1:
+        supervise(args.slots)
+    else:
+        run_worker()
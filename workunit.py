@@ -2,17 +2,25 @@
 
 """Representation of a unit of work."""
 
-# All code for the work_queue and work_logs tables should reside here.
+# All code for the work_queue table should reside here. Job logs are stored
+# by logstore.
 
 
 import cgi
 import datetime
+import glob
 import json
-import _mysql
+import MySQLdb
 import os
 import re
+import shutil
 import uuid
 
+import heartbeat
+import logshipper
+import logstore
+import results
+import staticfiles
 import utils
 
 
@@ -28,14 +36,20 @@ current state of trunk, and then finally the upgrade(s) contained in the
 patchset. For more information, please contact
 <a href="mailto:mikal@stillhq.com">mikal@stillhq.com</a>.</p>"""
 
+# Log lines per page of log.html, log-2.html and so on
+LOG_PAGE_LINES = 5000
+
 
 # Remember that the timestamp isn't actually part of the log row!
 UPGRADE_BEGIN_RE = re.compile('\*+ DB upgrade to state of (.*) starts \*+')
 UPGRADE_END_RE = re.compile('\*+ DB upgrade to state of (.*) finished \*+')
+CACHED_UPGRADE_RE = re.compile('\*+ DB upgrade to state of (.*) cached, '
+                               'originally took ([0-9.]+) seconds \*+')
 
 GIT_CHECKOUT_RE = re.compile('/srv/git-checkouts/[a-z]+/'
-                             '[a-z]+_refs_changes_[0-9_]+')
-VENV_PATH_RE = re.compile('/home/mikal/\.virtualenvs/refs_changes_[0-9_]+')
+                             '[a-z]+_refs_changes_[0-9_]+(slot[0-9]+)?')
+VENV_PATH_RE = re.compile('/home/mikal/\.virtualenvs/refs_changes_[0-9_]+'
+                          '(slot[0-9]+)?')
 
 MIGRATION_START_RE = re.compile('([0-9]+) -&gt; ([0-9]+)\.\.\.$')
 MIGRATION_END_RE = re.compile('^done$')
@@ -44,30 +58,139 @@ FINAL_VERSION_RE = re.compile('Final schema version is ([0-9]+)')
 MIGRATION_CLASH_RE = re.compile('Error: migration number .* appears '
                                 'more than once')
 GIT_CHECKOUT_FAILED_RE = re.compile('Git merge failure detected')
+CHECKOUT_RE = re.compile('Git checkout took ([0-9.]+) seconds and uses '
+                         '([0-9]+) KB')
+RESTORE_TIME_RE = re.compile('Dataset .* restored to .* by ([a-z]+) in '
+                             '([0-9.]+) seconds')
+
+# Matches every line persist_to_disk needs to look at more closely, so the
+# rest only cost one search. The migration markers are matched against the
+# escaped line, so their unescaped forms are used here.
+LINE_FILTER_RE = re.compile('|'.join([UPGRADE_BEGIN_RE.pattern,
+                                      UPGRADE_END_RE.pattern,
+                                      CACHED_UPGRADE_RE.pattern,
+                                      FINAL_VERSION_RE.pattern,
+                                      MIGRATION_CLASH_RE.pattern,
+                                      GIT_CHECKOUT_FAILED_RE.pattern,
+                                      CHECKOUT_RE.pattern,
+                                      RESTORE_TIME_RE.pattern,
+                                      '[0-9]+ -> [0-9]+\.\.\.',
+                                      '^done']))
 
 
 class NoWorkFound(Exception):
     pass
 
 
-def dequeue_work(cursor, worker, constraints):
-    selectid = str(uuid.uuid4())
-    cursor.execute('update work_queue set selectid="%s", worker="%s", '
-                   'heartbeat = NOW() where selectid is NULL and '
-                   'constraints="%s" limit 1;'
-                   %(selectid, worker, constraints))
+class LeaseLost(Exception):
+    pass
+
+
+# Queue priorities, highest is claimed first
+PRIORITY_RECHECK = 20
+PRIORITY_NEW = 10
+PRIORITY_BACKFILL = 0
+
+# Patchsets older than this are backfill rather than fresh
+BACKFILL_AGE = datetime.timedelta(days=1)
+
+_skip_locked = True
+
+
+def priority_for_patchset(timestamp):
+    if datetime.datetime.now() - timestamp > BACKFILL_AGE:
+        return PRIORITY_BACKFILL
+    return PRIORITY_NEW
+
+
+def dequeue_work_batch(cursor, worker, constraints, count=1):
+    """Claim up to count pending work units, highest priority first.
+
+    The pending rows are locked with SELECT ... FOR UPDATE SKIP LOCKED, so
+    concurrent workers claim disjoint rows without waiting on each other.
+    Servers without SKIP LOCKED (before MySQL 8.0) fall back to a plain
+    FOR UPDATE, which is still correct but serializes claims.
+    """
+
+    global _skip_locked
+
+    # Start from a fresh snapshot of the queue
     cursor.execute('commit;')
 
-    cursor.execute('select * from work_queue where selectid="%s";'
-                   % selectid)
-    if cursor.rowcount == 0:
+    sql = ('select id, number, workname, constraints, attempt '
+           'from work_queue where selectid is NULL and constraints="%s" '
+           'order by priority desc limit %d for update'
+           %(constraints, count))
+    if _skip_locked:
+        try:
+            cursor.execute(sql + ' skip locked;')
+        except MySQLdb.ProgrammingError:
+            print 'Database does not support SKIP LOCKED, falling back'
+            _skip_locked = False
+            cursor.execute('rollback;')
+    if not _skip_locked:
+        cursor.execute(sql + ';')
+    rows = cursor.fetchall()
+
+    if not rows:
+        cursor.execute('commit;')
         raise NoWorkFound()
 
-    row = cursor.fetchone()
-    w = WorkUnit(row['id'], row['number'], row['workname'],
-                 row['attempt'], row['constraints'])
-    w.worker = row['worker']
-    return w
+    selectid = str(uuid.uuid4())
+    work = []
+    for row in rows:
+        cursor.execute('update work_queue set selectid="%s", worker="%s", '
+                       'heartbeat = NOW() where id="%s" and number=%s and '
+                       'workname="%s" and constraints="%s" and attempt=%s;'
+                       %(selectid, worker, row['id'], row['number'],
+                         row['workname'], row['constraints'],
+                         row['attempt']))
+        w = WorkUnit(row['id'], row['number'], row['workname'],
+                     row['attempt'], row['constraints'])
+        w.worker = worker
+        work.append(w)
+    cursor.execute('commit;')
+    return work
+
+
+def dequeue_work(cursor, worker, constraints):
+    return dequeue_work_batch(cursor, worker, constraints)[0]
+
+
+def reap_expired_leases(cursor, lease_seconds):
+    """Requeue claimed work whose worker stopped renewing its lease.
+
+    The stalled row is marked with the "l" state and the same work is queued
+    again as the next attempt, so the stalled attempt's logs are kept.
+    """
+
+    cursor.execute('select * from work_queue where selectid is not NULL and '
+                   'done is NULL and heartbeat < NOW() - INTERVAL %d SECOND;'
+                   % lease_seconds)
+    reaped = 0
+    for row in cursor.fetchall():
+        # Only requeue if the lease is still expired, in case the worker
+        # came back or another reaper got here first.
+        cursor.execute('update work_queue set done="l", changed=NOW() '
+                       'where id="%s" and number=%s and workname="%s" and '
+                       'constraints="%s" and attempt=%s and done is NULL and '
+                       'heartbeat < NOW() - INTERVAL %d SECOND;'
+                       %(row['id'], row['number'], row['workname'],
+                         row['constraints'], row['attempt'], lease_seconds))
+        if cursor.rowcount == 1:
+            cursor.execute('insert ignore into work_queue(id, number, '
+                           'workname, constraints, attempt, priority) '
+                           'values ("%s", %s, "%s", "%s", %s, %s);'
+                           %(row['id'], row['number'], row['workname'],
+                             row['constraints'], row['attempt'] + 1,
+                             row['priority']))
+            print ('%s Lease expired for %s %s %s %s(%s) on %s, requeued'
+                   %(datetime.datetime.now(), row['id'], row['number'],
+                     row['workname'], row['constraints'], row['attempt'],
+                     row['worker']))
+            reaped += 1
+        cursor.execute('commit;')
+    return reaped
 
 
 def recheck(cursor, ident, number, workname=None):
@@ -91,9 +214,10 @@ def recheck(cursor, ident, number, workname=None):
     constraints = ['mysql', 'percona']
     for constraint in constraints:
         cursor.execute('insert into work_queue(id, number, workname, '
-                       'constraints, attempt) '
-                       'values ("%s", %s, "%s", "%s", %s);'
-                       %(ident, number, workname, constraint, attempt))
+                       'constraints, attempt, priority) '
+                       'values ("%s", %s, "%s", "%s", %s, %d);'
+                       %(ident, number, workname, constraint, attempt,
+                         PRIORITY_RECHECK))
         cursor.execute('commit;')
         print 'Added recheck for %s %s %s %s' %(ident, number, workname,
                                                 constraint)
@@ -116,6 +240,98 @@ def find_latest_attempts(cursor, ident, number, workname):
                        constraint)
 
 
+def replay_log_spools(cursor, worker):
+    """Push log lines spooled by worker while the database was unreachable.
+
+    Other worker slots on this machine may still be appending to, and
+    replaying, their own spools, so those are left alone.
+    """
+
+    for path in sorted(glob.glob('/srv/logs/*/*.log.spool')):
+        entries = {}
+        order = []
+        for unit, timestamp, log in logshipper.read_spool(path):
+            if not unit in entries:
+                order.append(unit)
+                entries[unit] = []
+            entries[unit].append((timestamp, log))
+
+        # unit is (ident, number, workname, worker, constraints, attempt)
+        if [unit for unit in order if unit[3] != worker]:
+            continue
+
+        for unit in order:
+            ident, number, workname, worker, constraints, attempt = unit
+            w = WorkUnit(ident, number, workname, attempt, constraints)
+            w.worker = worker
+            w.append_log_segment(cursor, entries[unit])
+        os.unlink(path)
+        print ('%s Replayed log spool %s'
+               %(datetime.datetime.now(), path))
+
+
+def log_page_name(page):
+    """The file name of a page of a job's log, counting from 1."""
+
+    if page == 1:
+        return 'log.html'
+    return 'log-%d.html' % page
+
+
+def log_page_contents(pages, current):
+    """Links to each page of a log, for the top and bottom of every page."""
+
+    if len(pages) < 2:
+        return ''
+
+    links = []
+    for i, page in enumerate(pages):
+        if page is current:
+            links.append('<b>%d</b>' %(i + 1))
+        else:
+            links.append('<a href="%s" title="From line %d at %s">%d</a>'
+                         %(page['name'], page['first'],
+                           page['timestamp'].replace(microsecond=0), i + 1))
+    return '<p>Log page %s</p>\n' % ' '.join(links)
+
+
+LOG_REDIRECT = """<script>
+var pages = %(pages)s;
+var upgrades = %(upgrades)s;
+var anchor = location.hash.substring(1);
+var page = upgrades[anchor];
+if (!page && /^[0-9]+$/.test(anchor)) {
+  for (var i = 0; i < pages.length; i++) {
+    if (pages[i][1] <= parseInt(anchor, 10)) {
+      page = pages[i][0];
+    }
+  }
+}
+if (page && page != '%(current)s') {
+  location.replace(page + location.hash);
+}
+</script>
+"""
+
+
+def log_page_redirect(pages, upgrade_pages):
+    """Send links to anchors on log.html to the page the anchor is now on.
+
+    Line and upgrade anchors used to all be on log.html, so links to them
+    from before the log was split into pages would otherwise break.
+    """
+
+    if len(pages) < 2:
+        return ''
+
+    # Upgrade names come from the log, so can't be allowed to end the script
+    upgrades = json.dumps(upgrade_pages).replace('</', '<\\/')
+    return LOG_REDIRECT % {'pages': json.dumps([[p['name'], p['first']]
+                                                for p in pages]),
+                           'upgrades': upgrades,
+                           'current': pages[0]['name']}
+
+
 class WorkUnit(object):
     def __init__(self, ident, number, workname, attempt, constraints):
         self.ident = ident
@@ -124,73 +340,117 @@ class WorkUnit(object):
         self.attempt = attempt
         self.constraints = constraints
         self.worker = None
+        self.shipper = None
+        self.heartbeater = None
+        self.slot = None
+        # Set once the reaper has requeued this unit from under us
+        self.lease_lost = False
 
-    def enqueue(self, cursor):
+    def enqueue(self, cursor, priority=PRIORITY_NEW):
         cursor.execute('insert ignore into work_queue'
-                       '(id, number, workname, constraints, attempt) '
-                       'values ("%s", %s, "%s", "%s", %s);'
+                       '(id, number, workname, constraints, attempt, '
+                       'priority) '
+                       'values ("%s", %s, "%s", "%s", %s, %d);'
                        %(self.ident, self.number, self.workname,
-                         self.constraints, self.attempt))
+                         self.constraints, self.attempt, priority))
         cursor.execute('commit;')
 
+    def start_heartbeat(self, **kwargs):
+        """Renew this unit's lease from a background thread."""
+        self.heartbeater = heartbeat.Heartbeat(self, **kwargs)
+        self.heartbeater.start()
+
+    def stop_heartbeat(self):
+        if self.heartbeater:
+            self.heartbeater.stop()
+            self.heartbeater = None
+
     def heartbeat(self, cursor):
+        """Renew the lease. Returns False if it has been lost."""
+
         cursor.execute('update work_queue set heartbeat=NOW() where '
                        'id="%s" and number=%s and workname="%s" and '
-                       'worker="%s" and constraints="%s" and attempt=%s;'
+                       'worker="%s" and constraints="%s" and attempt=%s '
+                       'and done is NULL;'
                        %(self.ident, self.number, self.workname, self.worker,
                         self.constraints, self.attempt))
+        renewed = cursor.rowcount > 0
         cursor.execute('commit;')
+        if not renewed:
+            # rowcount only counts changed rows, and a renewal within the
+            # same second as the last one changes nothing, so check whether
+            # the row was still ours
+            cursor.execute('select worker, done from work_queue where '
+                           'id="%s" and number=%s and workname="%s" and '
+                           'constraints="%s" and attempt=%s;'
+                           %(self.ident, self.number, self.workname,
+                             self.constraints, self.attempt))
+            row = cursor.fetchone()
+            renewed = (row is not None and row['worker'] == self.worker
+                       and row['done'] is None)
+            cursor.execute('commit;')
+        if not renewed:
+            self.lease_lost = True
+        return renewed
 
 
     def clear_log(self, cursor):
-        cursor.execute('delete from work_logs where id="%s" and number=%s and '
-                       'workname="%s" and constraints="%s" and attempt=%s;'
-                       %(self.ident, self.number, self.workname,
-                         self.constraints, self.attempt))
-        cursor.execute('commit;')
+        logstore.clear(cursor, self)
+
+    def slot_suffix(self):
+        """Suffix for resources which must not be shared between slots."""
+        if self.slot is None:
+            return ''
+        return '_slot%d' % self.slot
+
+    def log_path(self):
+        return os.path.join('/srv/logs', self.ident,
+                            (str(self.number) +
+                             (utils.format_attempt_path(self.attempt) +
+                              '_' + self.workname + '.log')))
+
+    def start_log_shipper(self, **kwargs):
+        """Ship log lines from a background thread instead of inline."""
+        self.shipper = logshipper.LogShipper(self, **kwargs)
+        self.shipper.start()
+
+    def stop_log_shipper(self):
+        if self.shipper:
+            self.shipper.stop()
+            self.shipper = None
 
     def log(self, cursor, l):
         timestamp = datetime.datetime.now()
         print '%s %s' % (timestamp, l.rstrip())
-        self.batchlog(cursor, [(timestamp, l)])
+        if self.shipper:
+            self.shipper.add(timestamp, l)
+        else:
+            self.batchlog(cursor, [(timestamp, l)])
+
+    def append_log_segment(self, cursor, entries):
+        logstore.append_segment(cursor, self, entries)
 
     def batchlog(self, cursor, entries):
-        logdir = os.path.join('/srv/logs', self.ident)
+        logpath = self.log_path()
+        logdir = os.path.dirname(logpath)
         if not os.path.exists(logdir):
            os.makedirs(logdir)
 
-        logpath = os.path.join(logdir,
-                               (str(self.number) +
-                                (utils.format_attempt_path(self.attempt) +
-                                 '_' + self.workname + '.log')))
-
         with open(logpath, 'a+') as f:
-            sql = ('insert into work_logs(id, number, workname, worker, log, '
-                   'timestamp, constraints, attempt) values ')
-            values = []
             for timestamp, log in entries:
-                values.append('("%s", %s, "%s", "%s", "%s", %s, "%s", %s)'
-                              %(self.ident, self.number, self.workname,
-                                self.worker, _mysql.escape_string(log),
-                                utils.datetime_as_sql(timestamp),
-                                self.constraints, self.attempt))
-            f.write('%s %s\n' %(timestamp, log.rstrip()))
+                f.write('%s %s\n' %(timestamp, log.rstrip()))
 
-        sql += ', '.join(values)
-        sql += ';'
-
-        cursor.execute(sql)
-        cursor.execute('commit;')
+        self.append_log_segment(cursor, entries)
 
         if len(entries) > 1:
             print '%s Pushed %d log lines to server' %(datetime.datetime.now(),
                                                        len(entries))
-        self.heartbeat(cursor)
 
     # Valid work done statuses:
     #    y = work done
     #    m = plugin not found
     #    c = git conflict during checkout
+    #    l = lease expired, requeued as a new attempt
 
     def set_conflict(self, cursor):
         self.set_state(cursor, 'c')
@@ -205,12 +465,23 @@ class WorkUnit(object):
         self.set_state(cursor, 'm')
 
     def set_state(self, cursor, state):
-        cursor.execute('update work_queue set done="%s" '
+        # Every log line must be in the database before the unit is finished,
+        # otherwise the dumper can render a truncated log.
+        self.stop_log_shipper()
+        self.stop_heartbeat()
+        # Only while we still hold the lease, as otherwise the unit has
+        # been requeued and is someone else's to finish
+        cursor.execute('update work_queue set done="%s", changed=NOW() '
                        'where id="%s" and number=%s and workname="%s" '
-                       'and constraints="%s" and attempt=%s;'
+                       'and constraints="%s" and attempt=%s and '
+                       'worker="%s" and done is NULL;'
                        %(state, self.ident, self.number, self.workname,
-                         self.constraints, self.attempt))
+                         self.constraints, self.attempt, self.worker))
+        finished = cursor.rowcount > 0
         cursor.execute('commit;')
+        if not finished:
+            self.lease_lost = True
+            raise LeaseLost()
 
     def record_migration(self, cursor, migration, name):
         cursor.execute('insert ignore into patchset_migrations'
@@ -257,118 +528,189 @@ class WorkUnit(object):
         print path
         if not os.path.exists(path):
             os.makedirs(path)
-        with open(workerpath, 'w') as f:
+        with staticfiles.StaticFile(workerpath) as f:
             f.write(self.worker)
-        with open(os.path.join(path, 'log.html'), 'w') as f:
-            buffered = []
-            upgrades = []
-            upgrade_times = {}
-            in_upgrade = False
-            migration_start = None
-            final_version = None
-
-            cursor.execute('select * from work_logs where id="%s" and '
-                           'number=%s and workname="%s" and '
-                           'worker="%s" and constraints="%s" and attempt=%s '
-                           'order by timestamp asc;'
-                           %(self.ident, self.number, self.workname,
-                             self.worker, self.constraints, self.attempt))
-            linecount = 0
-            f.write(LOG_HEADER %{'id': self.ident,
-                                 'number': self.number})
-
-            data = {}
-            for logrow in cursor:
-                m = FINAL_VERSION_RE.match(logrow['log'])
-                if m:
-                    final_version = int(m.group(1))
-
-                m = UPGRADE_BEGIN_RE.match(logrow['log'])
-                if m:
-                    upgrade_name = m.group(1)
-                    upgrades.append(upgrade_name)
-                    upgrade_start = logrow['timestamp']
-                    in_upgrade = True
-
-                    buffered.append('<a name="%s"></a>' % upgrade_name)
-
-                m = MIGRATION_CLASH_RE.match(logrow['log'])
-                if m:
-                    data['color'] = 'bgcolor="#FA5858"'
-                    data['result'] = 'Failed: migration number clash'
-                    print '    Failed'
-                    outcome = 'Failed'
-
-                m = GIT_CHECKOUT_FAILED_RE.match(logrow['log'])
-                if m:
-                    data['color'] = 'bgcolor="#F4FA58"'
-                    data['result'] = 'Warning: merge failure'
-                    print '    Warning'
-                    outcome = 'Warning'
-
-                line = ('<a name="%(linenum)s"></a>'
-                        '<a href="#%(linenum)s">#</a> '
-                        % {'linenum': linecount})
-                if in_upgrade:
-                    line += '<b>'
-
-                cleaned = logrow['log'].rstrip()
-                cleaned = cleaned.replace('/srv/openstack-ci-tools', '...')
-                cleaned = GIT_CHECKOUT_RE.sub('...git...', cleaned)
-                cleaned = VENV_PATH_RE.sub('...venv...', cleaned)
-                cleaned = cgi.escape(cleaned)
-
-                m = MIGRATION_END_RE.match(cleaned)
-                if m and migration_start:
-                    elapsed = logrow['timestamp'] - migration_start
-                    cleaned += ('              <font color="red">[%s]</font>'
-                                % utils.timedelta_as_str(elapsed))
-                    migration_start = None
-
-                m = MIGRATION_START_RE.match(cleaned)
-                if m:
-                    migration_start = logrow['timestamp']
-                    subcursor.execute('select * from patchset_migrations '
-                                      'where id="%s" and number=%s and '
-                                      'migration=%s;'
-                                      %(self.ident, self.number, m.group(2)))
-                    subrow = subcursor.fetchone()
-                    if subrow:
-                        cleaned += ('     <font color="red">[%s]</font>'
-                                    % subrow['name'])
-
-                line += ('%(timestamp)s %(line)s'
-                         % {'timestamp': logrow['timestamp'],
-                            'line': cleaned})
-                if in_upgrade:
-                    line += '</b>'
-                line += '\n'
-                buffered.append(line)
-
-                linecount += 1
-
-                m = UPGRADE_END_RE.match(logrow['log'])
-                if m:
-                    in_upgrade = False
-                    elapsed = logrow['timestamp'] - upgrade_start
-                    elapsed_str = utils.timedelta_as_str(elapsed)
-                    buffered.append('                                   '
-                                    '     <font color="red"><b>'
-                                    '[%s total]</b></font>\n'
-                                    % elapsed_str)
-                    upgrade_times[upgrade_name] = elapsed
+        # The log is split into pages of LOG_PAGE_LINES records. Each page's
+        # body is streamed to a scratch file, as the list of upgrades and of
+        # pages which heads every page is only known once every line has been
+        # read.
+        pages = []
+        try:
+            upgrade_pages = {}
+            body = None
+            try:
+                upgrades = []
+                upgrade_times = {}
+                cached = []
+                in_upgrade = False
+                migration_start = None
+                final_version = None
+
+                subcursor.execute('select migration, name from '
+                                  'patchset_migrations where id="%s" and '
+                                  'number=%s;'
+                                  %(self.ident, self.number))
+                migration_names = {}
+                for subrow in subcursor:
+                    migration_names[str(subrow['migration'])] = subrow['name']
+
+                # A server side cursor, so long logs aren't held in memory
+                logcursor = utils.get_streaming_cursor()
+                linecount = 0
+
+                data = {}
+                for logrow in logstore.read_records(logcursor, self):
+                    log = logrow['log']
+
+                    if body is None or pages[-1]['records'] >= LOG_PAGE_LINES:
+                        if body:
+                            body.close()
+                        pages.append({'name': log_page_name(len(pages) + 1),
+                                      'first': linecount,
+                                      'timestamp': logrow['timestamp'],
+                                      'records': 0})
+                        body = open(os.path.join(path, pages[-1]['name'] +
+                                                 '.body'), 'w')
+                    pages[-1]['records'] += 1
+
+                    # Most lines match nothing, so only lines which match the
+                    # combined pattern are checked against each one in turn.
+                    special = LINE_FILTER_RE.search(log)
+
+                    if special:
+                        m = FINAL_VERSION_RE.match(log)
+                        if m:
+                            final_version = int(m.group(1))
+
+                        m = UPGRADE_BEGIN_RE.match(log)
+                        if m:
+                            upgrade_name = m.group(1)
+                            upgrades.append(upgrade_name)
+                            upgrade_pages[upgrade_name] = pages[-1]['name']
+                            upgrade_start = logrow['timestamp']
+                            in_upgrade = True
+
+                            body.write('<a name="%s"></a>' % upgrade_name)
+
+                        m = CACHED_UPGRADE_RE.search(log)
+                        if m:
+                            upgrades.append(m.group(1))
+                            upgrade_pages[m.group(1)] = pages[-1]['name']
+                            upgrade_times[m.group(1)] = datetime.timedelta(
+                                seconds=float(m.group(2)))
+                            cached.append(m.group(1))
+                            body.write('<a name="%s"></a>' % m.group(1))
+
+                        m = MIGRATION_CLASH_RE.match(log)
+                        if m:
+                            data['color'] = 'bgcolor="#FA5858"'
+                            data['result'] = 'Failed: migration number clash'
+                            print '    Failed'
+                            outcome = 'Failed'
+
+                        m = CHECKOUT_RE.match(log)
+                        if m:
+                            data['checkout_seconds'] = float(m.group(1))
+                            data['checkout_kb'] = int(m.group(2))
+
+                        m = RESTORE_TIME_RE.search(log)
+                        if m:
+                            data['restore_method'] = m.group(1)
+                            data['restore_seconds'] = float(m.group(2))
+
+                        m = GIT_CHECKOUT_FAILED_RE.match(log)
+                        if m:
+                            data['color'] = 'bgcolor="#F4FA58"'
+                            data['result'] = 'Warning: merge failure'
+                            print '    Warning'
+                            outcome = 'Warning'
+
+                    line = ('<a name="%(linenum)s"></a>'
+                            '<a href="#%(linenum)s">#</a> '
+                            % {'linenum': linecount})
+                    if in_upgrade:
+                        line += '<b>'
+
+                    cleaned = log.rstrip()
+                    if cleaned.find('/srv/') != -1:
+                        cleaned = cleaned.replace('/srv/openstack-ci-tools',
+                                                  '...')
+                        cleaned = GIT_CHECKOUT_RE.sub('...git...', cleaned)
+                    if cleaned.find('.virtualenvs') != -1:
+                        cleaned = VENV_PATH_RE.sub('...venv...', cleaned)
+                    cleaned = cgi.escape(cleaned)
+
+                    if special:
+                        m = MIGRATION_END_RE.match(cleaned)
+                        if m and migration_start:
+                            elapsed = logrow['timestamp'] - migration_start
+                            cleaned += ('              <font color="red">[%s]'
+                                        '</font>'
+                                        % utils.timedelta_as_str(elapsed))
+                            migration_start = None
+
+                        m = MIGRATION_START_RE.match(cleaned)
+                        if m:
+                            migration_start = logrow['timestamp']
+                            if m.group(2) in migration_names:
+                                cleaned += ('     <font color="red">'
+                                            '[%s]</font>'
+                                            % migration_names[m.group(2)])
+
+                    if logrow['count'] > 1:
+                        cleaned += ('     <font color="gray">'
+                                    '[repeated %d times until %s]</font>'
+                                    %(logrow['count'],
+                                      logrow['last_timestamp'].replace(
+                                          microsecond=0)))
+
+                    line += ('%(timestamp)s %(line)s'
+                             % {'timestamp': logrow['timestamp'].replace(
+                                    microsecond=0),
+                                'line': cleaned})
+                    if in_upgrade:
+                        line += '</b>'
+                    line += '\n'
+                    body.write(line)
+
+                    # Anchors are line numbers, counting collapsed repeats
+                    linecount += logrow['count']
+
+                    if special and UPGRADE_END_RE.match(log):
+                        in_upgrade = False
+                        elapsed = logrow['timestamp'] - upgrade_start
+                        elapsed_str = utils.timedelta_as_str(elapsed)
+                        body.write('                                   '
+                                   '     <font color="red"><b>'
+                                   '[%s total]</b></font>\n'
+                                   % elapsed_str)
+                        upgrade_times[upgrade_name] = elapsed
+                logcursor.close()
+            finally:
+                if body:
+                    body.close()
+
+            if not pages:
+                pages.append({'name': log_page_name(1), 'first': 0,
+                              'timestamp': None, 'records': 0})
+                open(os.path.join(path, pages[0]['name'] + '.body'),
+                     'w').close()
 
             display_upgrades = []
             data.update({'order': upgrades,
                          'details' : {},
                          'details_seconds': {},
+                         'cached': cached,
                          'final_schema_version': final_version})
             for upgrade in upgrades:
                 time_str = utils.timedelta_as_str(upgrade_times[upgrade])
-                display_upgrades.append('<li><a href="#%(name)s">'
+                if upgrade in cached:
+                    time_str += ' (cached)'
+                display_upgrades.append('<li><a href="%(page)s#%(name)s">'
                                         'Upgrade to %(name)s -- '
                                         '%(elapsed)s</a>'
-                                        % {'name': upgrade,
+                                        % {'page': upgrade_pages[upgrade],
+                                           'name': upgrade,
                                            'elapsed': time_str})
                 data['details'][upgrade] = time_str
                 data['details_seconds'][upgrade] = \
@@ -404,27 +746,50 @@ class WorkUnit(object):
                     print '        Failed'
                     outcome = 'Failed'
 
-            f.write('<ul>%s</ul>' % ('\n'.join(display_upgrades)))
-            f.write('<pre><code>\n')
-            f.write(''.join(buffered))
-            f.write('</code></pre></body></html>')
-
-            with open(datapath, 'w') as d:
-                d.write(json.dumps(data))
-
-            subcursor.execute('update work_queue set outcome="%s" '
-                              'where id="%s" and number=%s '
-                              'and workname="%s" and constraints="%s" and '
-                              'attempt=%s;'
-                              %(outcome, self.ident, self.number,
-                                self.workname, self.constraints,
-                                self.attempt))
-            subcursor.execute('commit;')
+            for page in pages:
+                pagepath = os.path.join(path, page['name'])
+                with staticfiles.StaticFile(pagepath) as f:
+                    f.write(LOG_HEADER %{'id': self.ident,
+                                         'number': self.number})
+                    if page is pages[0]:
+                        f.write(log_page_redirect(pages, upgrade_pages))
+                    f.write('<ul>%s</ul>' % ('\n'.join(display_upgrades)))
+                    f.write(log_page_contents(pages, page))
+                    f.write('<pre><code>\n')
+                    with open(pagepath + '.body') as body:
+                        shutil.copyfileobj(body, f)
+                    f.write('</code></pre>')
+                    f.write(log_page_contents(pages, page))
+                    f.write('</body></html>')
+                os.unlink(pagepath + '.body')
+        finally:
+            # Don't leave scratch files in the public directory if rendering
+            # failed partway through
+            for scratch in glob.glob(os.path.join(path, 'log*.html.body')):
+                os.unlink(scratch)
+
+        # Pages left over from an earlier, longer rendering
+        for pagepath in glob.glob(os.path.join(path, 'log-*.html')):
+            if not os.path.basename(pagepath) in [p['name'] for p in pages]:
+                staticfiles.remove(pagepath)
+
+        with staticfiles.StaticFile(datapath) as d:
+            d.write(json.dumps(data))
+        results.record(subcursor, self, outcome, data)
+
+        subcursor.execute('update work_queue set outcome="%s" '
+                          'where id="%s" and number=%s '
+                          'and workname="%s" and constraints="%s" and '
+                          'attempt=%s;'
+                          %(outcome, self.ident, self.number,
+                            self.workname, self.constraints,
+                            self.attempt))
+        subcursor.execute('commit;')
 
 
     def mark_dumped(self, cursor):
-        cursor.execute('update work_queue set dumped="y" where '
-                       'id="%s" and number=%s and workname="%s" '
+        cursor.execute('update work_queue set dumped="y", changed=NOW() '
+                       'where id="%s" and number=%s and workname="%s" '
                        'and constraints="%s" and attempt=%s;'
                        %(self.ident, self.number, self.workname,
                          self.constraints, self.attempt))